@@ -1,36 +1,145 @@
 import os
+import re
+import sys
+import csv
+import gzip
+import copy
+import json
+import queue
+import atexit
+import argparse
+import functools
+import contextvars
+import tempfile
+import time
+import hashlib
+import asyncio
 import logging
+import logging.handlers
+import threading
+import sqlite3
 import datetime
-from typing import Optional, List, Tuple
+import difflib
+from collections import deque, Counter, OrderedDict
+from typing import Optional, List, Tuple, Dict, Callable
 
 from dotenv import load_dotenv
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
 
+try:
+    import numpy as np  # optional: vectorized candidate index
+except ImportError:
+    np = None
+
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Float, Boolean, DateTime,
-    ForeignKey, UniqueConstraint, and_, or_
+    create_engine, Column, Integer, String, Float, Boolean, DateTime, LargeBinary,
+    ForeignKey, UniqueConstraint, Index, and_, or_, func, select, bindparam, text,
+    inspect as sa_inspect, update as sa_update
 )
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 from telegram import (
     Update,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
-    LabeledPrice,
+    LabeledPrice, InputMediaPhoto, Message,
 )
+from telegram.error import BadRequest, RetryAfter, Forbidden
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, PreCheckoutQueryHandler,
-    filters
+    ConversationHandler, ContextTypes, PreCheckoutQueryHandler, TypeHandler,
+    BaseRateLimiter, BaseHandler, ApplicationHandlerStop, filters
 )
 
 # ----------------- LOGGING -----------------
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Handlers only put records on a queue; a listener thread formats them as JSON lines
+# and writes stderr. Records carry the update/user/handler of the update being handled,
+# and chatty INFO loggers are sampled (every Nth record kept, WARNING+ always kept).
+LOG_SAMPLE_EVERY = {
+    "apscheduler.executors.default": 100,  # "Running job ..." for every job run
+    f"{__name__}.updates": 10,             # per-update timing lines
+}
+SLOW_UPDATE_MS = 500  # updates slower than this are always logged
+
+log_context: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("log_context", default=None)
+
+class ContextFilter(logging.Filter):
+    """Copies the current update context onto the record in the emitting thread."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = log_context.get()
+        if ctx:
+            for key, value in ctx.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, every: Dict[str, int]):
+        super().__init__()
+        self.every = every
+        self.seen = Counter()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        n = self.every.get(record.name)
+        if not n or record.levelno >= logging.WARNING or getattr(record, "duration_ms", 0) >= SLOW_UPDATE_MS:
+            return True
+        self.seen[record.name] += 1
+        record.sample = n
+        return self.seen[record.name] % n == 1
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("update_id", "user_id", "handler", "duration_ms", "sample", "exc")
+    converter = time.gmtime
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in self.FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                out[key] = value
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # like QueueHandler.prepare, but the traceback stays a separate field instead of
+        # being appended to the message
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging() -> logging.handlers.QueueListener:
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+
+    queue_handler = JsonQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+
+    listener.start()
+    atexit.register(listener.stop)  # drains whatever is still queued
+    return listener
+
+log_listener = setup_logging()
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
+update_logger = logging.getLogger(f"{__name__}.updates")
 
 # ----------------- ENV -----------------
 load_dotenv()
@@ -70,14 +179,26 @@ class User(Base):
 
     profile_picture_file_id = Column(String, nullable=True)
     is_registered = Column(Boolean, default=False)
+    registered_at = Column(DateTime, nullable=True)        # profile completed (st_create_photo)
 
     referred_by_id = Column(Integer, nullable=True)        # telegram_id of referrer
-    referral_count = Column(Integer, default=0)            # successful referrals count
+    referral_count = Column(Integer, default=0, index=True)  # successful referrals count (leaderboard)
     referral_counted = Column(Boolean, default=False)      # for referred user: counted or not
 
     free_unlocks = Column(Integer, default=0)              # from referrals (1 per 3 successful)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    last_active_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)  # write-behind, see ACTIVITY
+
+# Long-inactive users are moved here (same columns) and restored on their next /start
+UsersArchive = User.__table__.to_metadata(Base.metadata, name="users_archive")
+
+# Declared after the archive copy so the archive doesn't clone them under the same name
+Index("ix_users_country_city", User.country.collate("NOCASE"), User.city.collate("NOCASE"))
+Index("ix_users_age", User.age)
+Index("ix_users_created_at", User.created_at)
+Index("ix_users_registered_at", User.registered_at, User.id)
+Index("ix_users_username_lower", func.lower(User.username))
 
 class BlockedProfile(Base):
     __tablename__ = "blocked_profiles"
@@ -91,9 +212,12 @@ class MatchRequest(Base):
     requester_id = Column(Integer, nullable=False, index=True)  # telegram_id
     target_id = Column(Integer, nullable=False, index=True)     # telegram_id
     purpose = Column(String, nullable=False)
-    status = Column(String, default="Pending")                  # Pending/Accepted/Rejected
+    status = Column(String, default="Pending")                  # Pending/Accepted/Rejected/Expired
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    __table_args__ = (UniqueConstraint("requester_id", "target_id", name="uq_req"),)
+    __table_args__ = (
+        UniqueConstraint("requester_id", "target_id", name="uq_req"),
+        Index("ix_match_requests_status_created", "status", "created_at"),
+    )
 
 class Match(Base):
     __tablename__ = "matches"
@@ -108,6 +232,21 @@ class Match(Base):
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     __table_args__ = (UniqueConstraint("user1_id", "user2_id", name="uq_match"),)
 
+class Payment(Base):
+    __tablename__ = "payments"
+    id = Column(Integer, primary_key=True)
+    telegram_payment_charge_id = Column(String, unique=True, nullable=False)  # idempotency key
+    provider_payment_charge_id = Column(String, nullable=True)
+    telegram_id = Column(Integer, nullable=False)
+    match_id = Column(Integer, nullable=True)
+    payload = Column(String, nullable=False)
+    currency = Column(String, nullable=False)
+    total_amount = Column(Integer, nullable=False)
+    status = Column(String, default="Received")  # Received/Applied/Rejected
+    note = Column(String, nullable=True)         # why it was rejected, for support
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (Index("ix_payments_user_created", "telegram_id", "created_at"),)
+
 class Report(Base):
     __tablename__ = "reports"
     id = Column(Integer, primary_key=True)
@@ -116,9 +255,168 @@ class Report(Base):
     reason = Column(String, nullable=False)
     status = Column(String, default="Pending")  # Pending/Reviewed
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (Index("ix_reports_status_created", "status", "created_at"),)
+
+class SeenFilter(Base):
+    __tablename__ = "seen_filters"
+    telegram_id = Column(Integer, primary_key=True)
+    current_bits = Column(LargeBinary, nullable=False)   # Bloom filter of profiles shown
+    previous_bits = Column(LargeBinary, nullable=True)   # previous generation, dropped on rotation
+    rotated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class ReportStat(Base):
+    __tablename__ = "report_stats"
+    reported_id = Column(Integer, primary_key=True)   # telegram_id
+    total_reports = Column(Integer, default=0)
+    distinct_reporters = Column(Integer, default=0)
+    last_report_at = Column(DateTime, nullable=True)
+    hidden = Column(Boolean, default=False)           # excluded from Find Match
+    __table_args__ = (
+        Index("ix_report_stats_severity", "distinct_reporters", "total_reports"),
+        Index("ix_report_stats_hidden", "hidden"),
+    )
+
+class ReportDigest(Base):
+    __tablename__ = "report_digests"
+    id = Column(Integer, primary_key=True)
+    last_report_id = Column(Integer, nullable=False)  # reports up to this id are covered
+    report_count = Column(Integer, default=0)
+    sent_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class RegionDaily(Base):
+    __tablename__ = "region_daily"
+    day = Column(String, primary_key=True)      # YYYY-MM-DD, UTC
+    country = Column(String, primary_key=True)  # "" when unknown
+    city = Column(String, primary_key=True)
+    signups = Column(Integer, default=0)
+    matches = Column(Integer, default=0)
+    reports = Column(Integer, default=0)
+
+class RegionTotal(Base):
+    __tablename__ = "region_totals"
+    country = Column(String, primary_key=True)
+    city = Column(String, primary_key=True)
+    registered = Column(Integer, default=0)     # snapshot from the last rollup run
+    signups = Column(Integer, default=0)
+    matches = Column(Integer, default=0)
+    reports = Column(Integer, default=0)
+
+class RollupWatermark(Base):
+    __tablename__ = "rollup_watermarks"
+    source = Column(String, primary_key=True)   # signups/matches/reports
+    last_id = Column(Integer, default=0)        # highest source row id already counted
+    last_at = Column(DateTime, nullable=True)   # signups: (registered_at, id) of the last row counted
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    reply_markup = Column(String, nullable=True)   # inline keyboard JSON or "main_menu"
+    dedup_key = Column(String, nullable=True, unique=True)
+    status = Column(String, default="Pending")     # Pending/Sent/Failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (Index("ix_outbox_status_next", "status", "next_attempt_at"),)
 
 Base.metadata.create_all(engine)
 
+def migrate_schema():
+    """create_all() skips tables that already exist; add columns and indexes introduced since."""
+    insp = sa_inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(dialect=engine.dialect)}"
+                    )
+    # reflection skips expression indexes, so compare names against sqlite_master instead
+    with engine.connect() as conn:
+        have = {r[0] for r in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in have:
+                index.create(engine)
+
+migrate_schema()
+
+def backfill_last_active():
+    """Rows from before last_active_at existed start their inactivity clock at rollout;
+    updated_at only tracks profile edits, so it says nothing about activity."""
+    t = User.__table__
+    with engine.begin() as conn:
+        conn.execute(
+            sa_update(t).where(t.c.last_active_at.is_(None))
+            .values(last_active_at=datetime.datetime.utcnow(), updated_at=t.c.updated_at)
+        )
+
+backfill_last_active()
+
+def backfill_registered_at():
+    """Profiles completed before registered_at existed use created_at. An old id-only signups
+    watermark is carried over as the latest created_at it covered, so nothing is counted twice."""
+    with engine.begin() as conn:
+        for t in (User.__table__, UsersArchive):
+            conn.execute(
+                sa_update(t).where(t.c.is_registered == True, t.c.registered_at.is_(None))
+                .values(registered_at=t.c.created_at, updated_at=t.c.updated_at)
+            )
+        w = RollupWatermark.__table__.c
+        last_id = conn.execute(
+            select(w.last_id).where(w.source == "signups", w.last_at.is_(None), w.last_id > 0)
+        ).scalar()
+        if last_id:
+            covered = conn.execute(select(func.max(User.created_at)).where(User.id <= last_id)).scalar()
+            conn.execute(sa_update(RollupWatermark.__table__).where(w.source == "signups").values(last_at=covered))
+
+backfill_registered_at()
+
+# Admin user search: an external-content FTS5 index over users, kept in sync by
+# triggers. Without FTS5 support search falls back to indexed username prefixes.
+USER_SEARCH_TRIGGERS = {
+    "users_fts_ai": """AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, name, username, city, country)
+        VALUES (new.id, new.name, new.username, new.city, new.country);
+    END""",
+    "users_fts_ad": """AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, name, username, city, country)
+        VALUES ('delete', old.id, old.name, old.username, old.city, old.country);
+    END""",
+    "users_fts_au": """AFTER UPDATE OF name, username, city, country ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, name, username, city, country)
+        VALUES ('delete', old.id, old.name, old.username, old.city, old.country);
+        INSERT INTO users_fts(rowid, name, username, city, country)
+        VALUES (new.id, new.name, new.username, new.city, new.country);
+    END""",
+}
+
+def setup_user_search() -> bool:
+    insp = sa_inspect(engine)
+    try:
+        with engine.begin() as conn:
+            created = not insp.has_table("users_fts")
+            conn.exec_driver_sql(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+                "name, username, city, country, content='users', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+            conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts_vocab USING fts5vocab(users_fts, 'row')")
+            for name, body in USER_SEARCH_TRIGGERS.items():
+                conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+            if created:
+                conn.exec_driver_sql("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+        return True
+    except OperationalError as e:
+        logger.warning("FTS5 unavailable (%s); admin search uses username prefixes only", e)
+        return False
+
+USER_SEARCH_FTS = setup_user_search()
+
 # ----------------- GEO -----------------
 geolocator = Nominatim(user_agent="trio-connect-bot")
 
@@ -132,6 +430,331 @@ geolocator = Nominatim(user_agent="trio-connect-bot")
     ST_ADMIN_VIEW_USER, ST_ADMIN_DELETE_USER,
 ) = range(19)
 
+# ----------------- OUTBOUND SCHEDULER -----------------
+# Every Bot API call goes through one rate limiter with a global and a per-chat token
+# bucket. Callers pass rate_limit_args=PRIORITY_* so that interactive replies are
+# always served before match notifications and broadcasts.
+PRIORITY_INTERACTIVE, PRIORITY_NOTIFICATION, PRIORITY_BROADCAST = 0, 1, 2
+PRIORITY_NAMES = ("interactive", "notification", "broadcast")
+GLOBAL_MSG_RATE = 25.0   # messages/sec for the whole bot (Telegram allows ~30)
+PER_CHAT_MSG_RATE = 1.0  # messages/sec per chat
+PER_CHAT_BURST = 3
+MAX_RETRY_AFTER = 3      # RetryAfter retries per request before giving up
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float, cost: float = 1.0) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def take(self, now: float, cost: float = 1.0) -> bool:
+        self._refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    def __init__(self, global_rate: float = GLOBAL_MSG_RATE, chat_rate: float = PER_CHAT_MSG_RATE,
+                 chat_burst: float = PER_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets: Dict[object, TokenBucket] = {}
+        self.queues = tuple(deque() for _ in PRIORITY_NAMES)  # (chat_id, future) per priority
+        self.paused_until = 0.0
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.retry_after_count = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.pump_task: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        self.wakeup = asyncio.Event()
+        self.pump_task = asyncio.create_task(self._pump())
+
+    async def shutdown(self) -> None:
+        if self.pump_task:
+            self.pump_task.cancel()
+            try:
+                await self.pump_task
+            except asyncio.CancelledError:
+                pass
+        for q in self.queues:
+            for _, fut in q:
+                if not fut.done():
+                    fut.cancel()
+            q.clear()
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {name: len(q) for name, q in zip(PRIORITY_NAMES, self.queues)}
+
+    def stats_text(self) -> str:
+        depths = ", ".join(f"{k} {v}" for k, v in self.queue_depths().items())
+        sent = ", ".join(f"{k} {v}" for k, v in zip(PRIORITY_NAMES, self.sent))
+        return f"Outbound queue: {depths}\nOutbound sent: {sent}\nFlood waits: {self.retry_after_count}"
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 50_000:
+                # forget chats whose bucket is full again, they behave like new ones
+                now = time.monotonic()
+                for cid in [c for c, b in self.chat_buckets.items() if b.wait_time(now, b.capacity) == 0]:
+                    del self.chat_buckets[cid]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, priority: int, chat_id):
+        fut = asyncio.get_running_loop().create_future()
+        self.queues[priority].append((chat_id, fut))
+        self.wakeup.set()
+        await fut
+
+    def _grant_one(self, now: float) -> Optional[float]:
+        """Releases the highest-priority waiter whose chat has a token.
+        Returns 0 when one was released, else seconds until a chat frees up (None if idle)."""
+        soonest = None
+        for q in self.queues:
+            for i, (chat_id, fut) in enumerate(q):
+                if fut.done():  # caller went away
+                    del q[i]
+                    return 0.0
+                bucket = self._chat_bucket(chat_id)
+                wait = bucket.wait_time(now)
+                if wait == 0:
+                    bucket.take(now)
+                    self.global_bucket.take(now)
+                    del q[i]
+                    fut.set_result(None)
+                    return 0.0
+                soonest = wait if soonest is None else min(soonest, wait)
+        return soonest
+
+    async def _pump(self):
+        while True:
+            now = time.monotonic()
+            if self.paused_until > now:
+                delay = self.paused_until - now
+            else:
+                delay = self.global_bucket.wait_time(now) or self._grant_one(now)
+                if delay == 0:
+                    continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        priority = rate_limit_args if rate_limit_args in (PRIORITY_NOTIFICATION, PRIORITY_BROADCAST) else PRIORITY_INTERACTIVE
+        attempts = 0
+        while True:
+            if chat_id is not None:
+                await self._acquire(priority, chat_id)
+            elif self.paused_until > time.monotonic():
+                await asyncio.sleep(self.paused_until - time.monotonic())
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent[priority] += 1
+                return result
+            except RetryAfter as e:
+                attempts += 1
+                self.retry_after_count += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + float(e.retry_after))
+                logger.warning("Flood limit on %s (%s), pausing %ss", endpoint, PRIORITY_NAMES[priority], e.retry_after)
+                if attempts > MAX_RETRY_AFTER:
+                    raise
+
+OUTBOUND_LIMITER = PriorityRateLimiter()
+
+# ----------------- OUTBOX -----------------
+# Messages to *other* users are written to the outbox in the same transaction as the
+# state change and delivered by a background dispatcher, so handlers never wait on them.
+OUTBOX_INTERVAL = 1.0      # seconds between dispatcher runs
+OUTBOX_BATCH = 50
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE = 5      # seconds, doubled per attempt
+OUTBOX_KEEP_DAYS = 3       # sent/failed rows (and their dedup keys) kept this long
+OUTBOX_MAIN_MENU = "main_menu"
+
+outbox_lock = asyncio.Lock()
+
+def enqueue_notification(session, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                         main_menu: bool = False, dedup_key: Optional[str] = None):
+    """Adds a message to the outbox inside the caller's transaction; duplicate dedup_keys are ignored."""
+    markup = OUTBOX_MAIN_MENU if main_menu else None
+    if reply_markup is not None:
+        markup = json.dumps(reply_markup.to_dict())
+    session.execute(
+        sqlite_insert(OutboxMessage)
+        .values(chat_id=chat_id, text=text, reply_markup=markup, dedup_key=dedup_key)
+        .on_conflict_do_nothing(index_elements=["dedup_key"])
+    )
+
+def kick_outbox(context: ContextTypes.DEFAULT_TYPE):
+    # deliver right away instead of waiting for the next dispatcher tick
+    if context.job_queue and not outbox_lock.locked():
+        context.job_queue.run_once(job_dispatch_outbox, 0)
+
+async def deliver_outbox_message(bot, chat_id: int, text: str, markup: Optional[str]):
+    reply_markup = None
+    if markup == OUTBOX_MAIN_MENU:
+        reply_markup = main_menu_kb()
+    elif markup:
+        reply_markup = InlineKeyboardMarkup.de_json(json.loads(markup), bot)
+    await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, rate_limit_args=PRIORITY_NOTIFICATION)
+
+async def job_dispatch_outbox(context: ContextTypes.DEFAULT_TYPE):
+    if outbox_lock.locked():
+        return
+    async with outbox_lock:
+        now = datetime.datetime.utcnow()
+        session = db_session()
+        try:
+            rows = session.query(
+                OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text,
+                OutboxMessage.reply_markup, OutboxMessage.attempts
+            ).filter(
+                OutboxMessage.status == "Pending", OutboxMessage.next_attempt_at <= now
+            ).order_by(OutboxMessage.id).limit(OUTBOX_BATCH).all()
+        finally:
+            session.close()
+        if not rows:
+            return
+
+        # sends run concurrently; the rate limiter spaces them out
+        results = await asyncio.gather(
+            *(deliver_outbox_message(context.bot, r.chat_id, r.text, r.reply_markup) for r in rows),
+            return_exceptions=True
+        )
+
+        session = db_session()
+        try:
+            sent_ids = [r.id for r, res in zip(rows, results) if not isinstance(res, Exception)]
+            if sent_ids:
+                session.query(OutboxMessage).filter(OutboxMessage.id.in_(sent_ids)).update(
+                    {OutboxMessage.status: "Sent"}, synchronize_session=False
+                )
+            for r, res in zip(rows, results):
+                if not isinstance(res, Exception):
+                    continue
+                attempts = (r.attempts or 0) + 1
+                values = {OutboxMessage.attempts: attempts}
+                if isinstance(res, Forbidden) or attempts >= OUTBOX_MAX_ATTEMPTS:
+                    values[OutboxMessage.status] = "Failed"
+                    logger.warning("Outbox message %s to %s failed: %s", r.id, r.chat_id, res)
+                else:
+                    values[OutboxMessage.next_attempt_at] = now + datetime.timedelta(seconds=OUTBOX_RETRY_BASE * 2 ** attempts)
+                session.query(OutboxMessage).filter_by(id=r.id).update(values, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+async def job_purge_outbox(context: ContextTypes.DEFAULT_TYPE):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=OUTBOX_KEEP_DAYS)
+    session = db_session()
+    try:
+        n = session.query(OutboxMessage).filter(
+            OutboxMessage.status.in_(["Sent", "Failed"]), OutboxMessage.created_at < cutoff
+        ).delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+    if n:
+        logger.info("Outbox purge: %s rows removed", n)
+
+# ----------------- EVENT LOG -----------------
+# Interaction events (view/like/skip/...) are appended to an in-memory buffer on the
+# hot path and written every few seconds, off the event loop, to JSONL segment files.
+# Segments rotate daily or by size and are gzip'd once closed; read_events streams them.
+EVENT_DIR = os.getenv("EVENT_DIR", "events")
+EVENT_FLUSH_INTERVAL = 5
+EVENT_SEGMENT_BYTES = 64 * 1024 * 1024
+EVENT_BUFFER_MAX = 100000  # oldest events are dropped if the writer falls this far behind
+
+event_buffer: deque = deque(maxlen=EVENT_BUFFER_MAX)
+event_write_lock = threading.Lock()
+event_segment: Dict[str, object] = {}  # "path", "day" of the open segment
+
+def log_event(kind: str, uid: int, other: Optional[int] = None, **extra):
+    ev = {"t": round(time.time(), 3), "e": kind, "u": uid}
+    if other is not None:
+        ev["o"] = other
+    ev.update(extra)
+    event_buffer.append(ev)
+
+def close_event_segment(path: str):
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+        dst.writelines(src)
+    os.remove(path)
+
+def open_event_segment() -> str:
+    day = datetime.datetime.utcnow().strftime("%Y%m%d")
+    path = event_segment.get("path")
+    if path and event_segment.get("day") == day and os.path.getsize(path) < EVENT_SEGMENT_BYTES:
+        return path
+
+    os.makedirs(EVENT_DIR, exist_ok=True)
+    # anything still uncompressed (including leftovers from a previous run) is closed now
+    for name in os.listdir(EVENT_DIR):
+        if name.startswith("events-") and name.endswith(".jsonl"):
+            close_event_segment(os.path.join(EVENT_DIR, name))
+    path = os.path.join(EVENT_DIR, f"events-{datetime.datetime.utcnow():%Y%m%d-%H%M%S-%f}.jsonl")
+    event_segment.update(path=path, day=day)
+    return path
+
+def write_events() -> int:
+    with event_write_lock:
+        lines = []
+        while event_buffer:
+            lines.append(json.dumps(event_buffer.popleft(), separators=(",", ":")))
+        if not lines:
+            return 0
+        with open(open_event_segment(), "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return len(lines)
+
+async def job_write_events(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(write_events)
+
+def read_events(since: Optional[datetime.datetime] = None, kinds: Optional[set] = None):
+    """Yields events oldest first, one line at a time; segments ending before since are skipped."""
+    if not os.path.isdir(EVENT_DIR):
+        return
+    names = sorted(n for n in os.listdir(EVENT_DIR) if n.startswith("events-"))
+    starts = [datetime.datetime.strptime(n[7:22], "%Y%m%d-%H%M%S") for n in names]
+    since_ts = since.replace(tzinfo=datetime.timezone.utc).timestamp() if since else None
+    for i, name in enumerate(names):
+        if since and i + 1 < len(starts) and starts[i + 1] <= since:
+            continue
+        path = os.path.join(EVENT_DIR, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                ev = json.loads(line)
+                if since_ts and ev["t"] < since_ts:
+                    continue
+                if kinds and ev["e"] not in kinds:
+                    continue
+                yield ev
+
+def event_funnel(since: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    return dict(Counter(ev["e"] for ev in read_events(since)))
+
 # ----------------- HELPERS -----------------
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_TELEGRAM_ID
@@ -147,6 +770,9 @@ def upsert_user_from_telegram(update: Update) -> User:
         full_name = (tg.full_name or tg.first_name or "User").strip()
         username = tg.username
 
+        if not user and restore_archived_user(session, tg.id):
+            user = session.query(User).filter_by(telegram_id=tg.id).first()
+
         if not user:
             user = User(telegram_id=tg.id, name=full_name, username=username)
             session.add(user)
@@ -210,6 +836,23 @@ def profile_caption(u: User, show_username: bool) -> str:
         cap += f"🔗 Username: @{u.username}\n"
     return cap
 
+def message_body(message: Message) -> str:
+    return message.caption or message.text or ""
+
+async def edit_or_reply(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                        fallback_markup=None) -> Message:
+    """Rewrites a bot message in place (caption for photos); sends a new one only if editing fails."""
+    try:
+        if message.photo:
+            await message.edit_caption(caption=text, reply_markup=reply_markup)
+        else:
+            await message.edit_text(text, reply_markup=reply_markup)
+        return message
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return message
+        return await message.reply_text(text, reply_markup=fallback_markup or reply_markup)
+
 async def ensure_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     tg = update.effective_user
     if tg.username:
@@ -230,8 +873,366 @@ async def ensure_username(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 def canonical_pair(a: int, b: int) -> Tuple[int, int]:
     return (a, b) if a < b else (b, a)
 
-def build_find_candidates(current_user: User, gender_filter: str) -> List[int]:
-    """Returns list of telegram_ids for matching browse, filtered and excluding blocked/requested/matched."""
+# ----------------- CANDIDATE INDEX -----------------
+# Optional in-process copy of the users table as NumPy columns, so candidate
+# queries are a vectorized mask + distance instead of a full ORM table load.
+CANDIDATE_INDEX_ENABLED = os.getenv("CANDIDATE_INDEX", "1") == "1"
+CANDIDATE_TOP_K = 1000  # nearest profiles returned per query
+GENDER_CODES = {"Male": 1, "Female": 2, "Other": 3}
+EARTH_RADIUS_KM = 6371.0
+
+class CandidateIndex:
+    COLUMNS = {
+        "telegram_id": ("int64", 0),
+        "lat": ("float64", float("nan")),
+        "lon": ("float64", float("nan")),
+        "gender": ("int8", 0),
+        "age": ("int16", 0),
+        "registered": ("bool", False),
+    }
+
+    def __init__(self, capacity: int = 1024):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.size = 0
+        self.rows: Dict[int, int] = {}  # telegram_id -> row
+        self.cols = {name: np.full(capacity, fill, dtype=dtype) for name, (dtype, fill) in self.COLUMNS.items()}
+
+    def _grow(self):
+        for name, (dtype, fill) in self.COLUMNS.items():
+            old = self.cols[name]
+            new = np.full(len(old) * 2, fill, dtype=dtype)
+            new[:len(old)] = old
+            self.cols[name] = new
+
+    def _set_row(self, row: int, telegram_id: int, lat, lon, gender, age, registered):
+        c = self.cols
+        c["telegram_id"][row] = telegram_id
+        c["lat"][row] = lat if lat is not None else np.nan
+        c["lon"][row] = lon if lon is not None else np.nan
+        c["gender"][row] = GENDER_CODES.get(gender, 0)
+        c["age"][row] = age or 0
+        c["registered"][row] = bool(registered)
+
+    def _upsert(self, telegram_id: int, lat, lon, gender, age, registered):
+        row = self.rows.get(telegram_id)
+        if row is None:
+            if self.size == len(self.cols["telegram_id"]):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.rows[telegram_id] = row
+        self._set_row(row, telegram_id, lat, lon, gender, age, registered)
+
+    def load(self):
+        session = db_session()
+        try:
+            rows = session.query(
+                User.telegram_id, User.latitude, User.longitude, User.gender, User.age, User.is_registered
+            ).yield_per(5000)
+            with self.lock:
+                self.size = 0
+                self.rows.clear()
+                for r in rows:
+                    self._upsert(*r)
+                self.loaded = True
+        finally:
+            session.close()
+        logger.info("Candidate index loaded: %s users", self.size)
+
+    def upsert(self, u: User):
+        with self.lock:
+            if self.loaded:
+                self._upsert(u.telegram_id, u.latitude, u.longitude, u.gender, u.age, u.is_registered)
+
+    def remove(self, telegram_id: int):
+        with self.lock:
+            row = self.rows.pop(telegram_id, None)
+            if row is None:
+                return
+            last = self.size - 1
+            if row != last:
+                for arr in self.cols.values():
+                    arr[row] = arr[last]
+                self.rows[int(self.cols["telegram_id"][row])] = row
+            self.size = last
+
+    def query(self, current_user: User, gender_filter: str, excluded: set,
+              seen: Optional[Callable[[int], bool]] = None, limit: int = CANDIDATE_TOP_K) -> List[int]:
+        if not self.loaded:
+            self.load()
+
+        with self.lock:
+            n = self.size
+            c = self.cols
+            mask = c["registered"][:n].copy()
+            code = GENDER_CODES.get(gender_filter)
+            if code:
+                mask &= c["gender"][:n] == code
+            if excluded:
+                mask &= ~np.isin(c["telegram_id"][:n], np.fromiter(excluded, dtype=np.int64, count=len(excluded)))
+            idx = np.flatnonzero(mask)
+            tids = c["telegram_id"][idx]
+            lat = c["lat"][idx]
+            lon = c["lon"][idx]
+
+        if current_user.latitude is None or current_user.longitude is None:
+            dist = np.arange(len(tids), dtype=np.float64)  # keep index order
+        else:
+            # haversine distance, profiles without a location go last
+            lat1, lon1 = np.radians(current_user.latitude), np.radians(current_user.longitude)
+            lat2, lon2 = np.radians(lat), np.radians(lon)
+            a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+            dist = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+            dist[np.isnan(dist)] = np.inf
+        return self._nearest(tids, dist, limit, seen)
+
+    @staticmethod
+    def _nearest(tids, dist, limit: int, seen: Optional[Callable[[int], bool]]) -> List[int]:
+        """Nearest limit ids, unseen before seen; the window widens until it holds limit unseen ones."""
+        window = limit * 2 if seen else limit
+        while True:
+            if len(dist) > window:
+                top = np.argpartition(dist, window - 1)[:window]
+                order = top[np.argsort(dist[top], kind="stable")]
+            else:
+                order = np.argsort(dist, kind="stable")
+            ranked = tids[order].tolist()
+            if not seen:
+                return ranked[:limit]
+            unseen, already = [], []
+            for tid in ranked:
+                (already if seen(tid) else unseen).append(tid)
+            if len(unseen) >= limit or len(ranked) == len(dist):
+                return (unseen + already)[:limit]
+            window *= 2
+
+CANDIDATE_INDEX: Optional[CandidateIndex] = CandidateIndex() if CANDIDATE_INDEX_ENABLED and np is not None else None
+
+def sync_candidate_index(telegram_id: int):
+    """Re-reads one user into the index after registration/edit; no-op when the index is off."""
+    if CANDIDATE_INDEX is None:
+        return
+    u = get_user(telegram_id)
+    if u:
+        CANDIDATE_INDEX.upsert(u)
+    else:
+        CANDIDATE_INDEX.remove(telegram_id)
+
+# ----------------- REPORT STATS -----------------
+REPORT_HIDE_THRESHOLD = 5  # distinct reporters before a profile is hidden from Find Match
+
+hidden_user_ids: set = set()  # mirror of report_stats.hidden, read on every candidate build
+
+def load_hidden_users():
+    session = db_session()
+    try:
+        rows = session.query(ReportStat.reported_id).filter(ReportStat.hidden == True).all()
+    finally:
+        session.close()
+    hidden_user_ids.clear()
+    hidden_user_ids.update(r[0] for r in rows)
+
+def rebuild_report_stats():
+    """One-off backfill of report_stats from the reports table (used when the table is new)."""
+    session = db_session()
+    try:
+        if session.query(ReportStat.reported_id).first() or not session.query(Report.id).first():
+            return
+        distinct = func.count(func.distinct(Report.reporter_id))
+        session.execute(
+            ReportStat.__table__.insert().from_select(
+                ["reported_id", "total_reports", "distinct_reporters", "last_report_at", "hidden"],
+                session.query(
+                    Report.reported_id, func.count(Report.id), distinct, func.max(Report.created_at),
+                    distinct >= REPORT_HIDE_THRESHOLD
+                ).group_by(Report.reported_id)
+            )
+        )
+        session.commit()
+        logger.info("report_stats rebuilt from reports")
+    finally:
+        session.close()
+
+def record_report_stat(session, reporter_id: int, reported_id: int) -> bool:
+    """Bumps the reported user's counters (call before adding the Report row).
+    Returns True when this report pushed them over REPORT_HIDE_THRESHOLD."""
+    first_from_reporter = session.query(Report.id).filter_by(reporter_id=reporter_id, reported_id=reported_id).first() is None
+    now = datetime.datetime.utcnow()
+    t = ReportStat.__table__.c
+    row = session.execute(
+        sqlite_insert(ReportStat)
+        .values(reported_id=reported_id, total_reports=1, distinct_reporters=1, last_report_at=now, hidden=False)
+        .on_conflict_do_update(
+            index_elements=["reported_id"],
+            set_={
+                "total_reports": t.total_reports + 1,
+                "distinct_reporters": t.distinct_reporters + (1 if first_from_reporter else 0),
+                "last_report_at": now,
+            }
+        )
+        .returning(ReportStat.distinct_reporters, ReportStat.hidden)
+    ).first()
+
+    # hide once, when the threshold is crossed; an admin unhide is not undone by later reports
+    if first_from_reporter and row.distinct_reporters == REPORT_HIDE_THRESHOLD and not row.hidden:
+        session.query(ReportStat).filter_by(reported_id=reported_id).update({ReportStat.hidden: True}, synchronize_session=False)
+        return True
+    return False
+
+def recount_report_stats(session, reported_ids) -> List[int]:
+    """Recounts report_stats after Report rows were deleted, so a reporter who deletes and
+    re-registers counts once. Returns ids whose auto-hide no longer holds (now unhidden)."""
+    unhidden = []
+    for rid in reported_ids:
+        st = session.query(ReportStat).filter_by(reported_id=rid).first()
+        if not st:
+            continue
+        total, distinct, last = session.query(
+            func.count(Report.id), func.count(func.distinct(Report.reporter_id)), func.max(Report.created_at)
+        ).filter(Report.reported_id == rid).one()
+        # only an auto-hide is undone; a manual hide below the threshold stays
+        if st.hidden and st.distinct_reporters >= REPORT_HIDE_THRESHOLD > distinct:
+            st.hidden = False
+            unhidden.append(rid)
+        if not total and not st.hidden:
+            session.delete(st)
+            continue
+        st.total_reports, st.distinct_reporters, st.last_report_at = total, distinct, last
+    return unhidden
+
+def set_user_hidden(telegram_id: int, hidden: bool):
+    if hidden:
+        hidden_user_ids.add(telegram_id)
+    else:
+        hidden_user_ids.discard(telegram_id)
+    mark_candidate_queues_stale()
+
+# ----------------- SEEN PROFILES -----------------
+# Profiles shown in Find Match go into a per-user Bloom filter (two generations, rotated
+# every SEEN_TTL_DAYS / 2) so later sessions show unseen people first without SQL lookups.
+SEEN_FILTER_BITS = 1 << 15        # 4 KiB per generation, ~1% false positives at ~3k profiles
+SEEN_FILTER_HASHES = 7
+SEEN_TTL_DAYS = 14
+SEEN_FLUSH_INTERVAL = 30          # seconds between write-behind flushes
+SEEN_CACHE_MAX = 5000             # clean filters kept in memory
+
+class BloomFilter:
+    __slots__ = ("bits",)
+
+    def __init__(self, data: Optional[bytes] = None):
+        self.bits = bytearray(data) if data else bytearray(SEEN_FILTER_BITS // 8)
+
+    def _positions(self, item: int):
+        h = hashlib.blake2b(item.to_bytes(8, "little", signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        m = len(self.bits) * 8
+        return [(h1 + i * h2) % m for i in range(SEEN_FILTER_HASHES)]
+
+    def add(self, item: int):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item: int) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+seen_cache: Dict[int, dict] = {}  # telegram_id -> {"current", "previous", "rotated_at"}
+seen_dirty: set = set()
+
+def load_seen_filter(uid: int) -> dict:
+    entry = seen_cache.get(uid)
+    if entry is not None:
+        return entry
+    session = db_session()
+    try:
+        row = session.query(SeenFilter).filter_by(telegram_id=uid).first()
+        if row:
+            entry = {
+                "current": BloomFilter(row.current_bits),
+                "previous": BloomFilter(row.previous_bits) if row.previous_bits else None,
+                "rotated_at": row.rotated_at or datetime.datetime.utcnow(),
+            }
+        else:
+            entry = {"current": BloomFilter(), "previous": None, "rotated_at": datetime.datetime.utcnow()}
+    finally:
+        session.close()
+    seen_cache[uid] = entry
+    return entry
+
+def has_seen(entry: dict, target_id: int) -> bool:
+    # same windows mark_seen's rotation would leave: everything has aged out after SEEN_TTL_DAYS
+    age = datetime.datetime.utcnow() - entry["rotated_at"]
+    if age >= datetime.timedelta(days=SEEN_TTL_DAYS):
+        return False
+    if target_id in entry["current"]:
+        return True
+    return entry["previous"] is not None and age < datetime.timedelta(days=SEEN_TTL_DAYS / 2) and target_id in entry["previous"]
+
+def mark_seen(uid: int, target_id: int):
+    entry = load_seen_filter(uid)
+    now = datetime.datetime.utcnow()
+    age = now - entry["rotated_at"]
+    if age >= datetime.timedelta(days=SEEN_TTL_DAYS / 2):
+        entry["previous"] = entry["current"] if age < datetime.timedelta(days=SEEN_TTL_DAYS) else None
+        entry["current"] = BloomFilter()
+        entry["rotated_at"] = now
+    entry["current"].add(target_id)
+    seen_dirty.add(uid)
+
+def unseen_first(entry: dict, ids: List[int]) -> List[int]:
+    """Stable partition: profiles not shown recently first, already-seen ones after them."""
+    unseen, seen = [], []
+    for tid in ids:
+        (seen if has_seen(entry, tid) else unseen).append(tid)
+    return unseen + seen
+
+def flush_seen_filters():
+    if not seen_dirty:
+        return
+    dirty = list(seen_dirty)
+    seen_dirty.clear()
+    rows = []
+    for uid in dirty:
+        entry = seen_cache.get(uid)
+        if entry:
+            rows.append({
+                "telegram_id": uid,
+                "current_bits": bytes(entry["current"].bits),
+                "previous_bits": bytes(entry["previous"].bits) if entry["previous"] else None,
+                "rotated_at": entry["rotated_at"],
+            })
+    session = db_session()
+    try:
+        stmt = sqlite_insert(SeenFilter)
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["telegram_id"],
+                set_={
+                    "current_bits": stmt.excluded.current_bits,
+                    "previous_bits": stmt.excluded.previous_bits,
+                    "rotated_at": stmt.excluded.rotated_at,
+                }
+            ),
+            rows
+        )
+        session.commit()
+    except Exception:
+        seen_dirty.update(dirty)
+        raise
+    finally:
+        session.close()
+
+    if len(seen_cache) > SEEN_CACHE_MAX:
+        for uid in [u for u in seen_cache if u not in seen_dirty][:len(seen_cache) - SEEN_CACHE_MAX]:
+            seen_cache.pop(uid, None)
+
+async def job_flush_seen_filters(context: ContextTypes.DEFAULT_TYPE):
+    flush_seen_filters()
+
+def build_find_candidates(current_user: User, gender_filter: str, seen: dict, hidden: set) -> List[int]:
+    """Returns list of telegram_ids for matching browse, filtered and excluding blocked/requested/matched.
+    seen (load_seen_filter) and hidden are taken by the caller on the event loop; this may run in a thread."""
     session = db_session()
     try:
         # Exclusions
@@ -245,12 +1246,7 @@ def build_find_candidates(current_user: User, gender_filter: str) -> List[int]:
         ).all()
         sent_req_ids = {x[0] for x in sent_req}
 
-        # Received pending requests from others (so we don't show them again)
-        recv_req = session.query(MatchRequest.requester_id).filter(
-            MatchRequest.target_id == current_user.telegram_id,
-            MatchRequest.status == "Pending"
-        ).all()
-        recv_req_ids = {x[0] for x in recv_req}
+        # Received pending requests are not excluded: liking one back is an instant match (cb_find_purpose)
 
         # Already matched
         matches = session.query(Match).filter(
@@ -260,7 +1256,11 @@ def build_find_candidates(current_user: User, gender_filter: str) -> List[int]:
         for m in matches:
             matched_ids.add(m.user2_id if m.user1_id == current_user.telegram_id else m.user1_id)
 
-        excluded = blocked_ids | sent_req_ids | recv_req_ids | matched_ids | {current_user.telegram_id}
+        excluded = blocked_ids | sent_req_ids | matched_ids | hidden | {current_user.telegram_id}
+
+        if CANDIDATE_INDEX is not None:
+            # seen profiles are ranked behind unseen ones before the top-K cut, not after it
+            return CANDIDATE_INDEX.query(current_user, gender_filter, excluded, seen=lambda tid: has_seen(seen, tid))
 
         q = session.query(User).filter(User.is_registered == True).filter(User.telegram_id.notin_(excluded))
 
@@ -284,10 +1284,89 @@ def build_find_candidates(current_user: User, gender_filter: str) -> List[int]:
                 return abs(x.latitude - current_user.latitude) + abs(x.longitude - current_user.longitude)
             users.sort(key=dist_key)
 
-        return [u.telegram_id for u in users]
+        return unseen_first(seen, [u.telegram_id for u in users])
     finally:
         session.close()
 
+# ----------------- CANDIDATE QUEUES -----------------
+# Ranked candidate lists are precomputed in the background per (user, filter),
+# so tapping a Find Match filter serves the first card without a table scan.
+FIND_FILTERS = ("Male", "Female", "Any")
+CANDIDATE_QUEUE_REFRESH_SECONDS = 60
+CANDIDATE_QUEUE_MAX_AGE = 300            # seconds, rebuild even if nothing invalidated it
+CANDIDATE_QUEUE_ACTIVE_WINDOW = 30 * 60  # seconds since last Find Match to keep precomputing
+
+candidate_queues: Dict[Tuple[int, str], dict] = {}  # (telegram_id, filter) -> {"ids", "built_at", "country", "stale"}
+candidate_queue_owners: Dict[int, float] = {}       # telegram_id -> last Find Match activity
+candidate_queue_gen: Dict[int, int] = {}            # bumped on invalidation, guards in-flight rebuilds
+
+def touch_candidate_queue_owner(uid: int):
+    candidate_queue_owners[uid] = time.monotonic()
+
+def invalidate_candidate_queues(*telegram_ids: int):
+    """Drops queues whose exclusions changed (block, request, match) so they are never served."""
+    for tid in telegram_ids:
+        candidate_queue_gen[tid] = candidate_queue_gen.get(tid, 0) + 1
+        for f in FIND_FILTERS:
+            candidate_queues.pop((tid, f), None)
+
+def mark_candidate_queues_stale(country: Optional[str] = None):
+    """A profile appeared/changed nearby: queues stay servable but get rebuilt on the next refresh."""
+    for entry in candidate_queues.values():
+        if country is None or entry["country"] == country:
+            entry["stale"] = True
+
+def store_candidate_queue(user: User, gender_filter: str, ids: List[int], gen: Optional[int] = None):
+    if gen is not None and candidate_queue_gen.get(user.telegram_id, 0) != gen:
+        return  # invalidated while this queue was being built
+    candidate_queues[(user.telegram_id, gender_filter)] = {
+        "ids": ids,
+        "built_at": time.monotonic(),
+        "country": user.country,
+        "stale": False,
+    }
+
+def take_candidate_queue(uid: int, gender_filter: str) -> Optional[List[int]]:
+    """Shared, not copied: sessions only read it and a rebuild replaces the list."""
+    entry = candidate_queues.get((uid, gender_filter))
+    if not entry:
+        return None
+    return entry["ids"]
+
+async def refresh_candidate_queues_for(uid: int, force: bool = False):
+    user = get_user(uid)
+    if not user or not user.is_registered:
+        candidate_queue_owners.pop(uid, None)
+        invalidate_candidate_queues(uid)
+        return
+
+    now = time.monotonic()
+    for f in FIND_FILTERS:
+        entry = candidate_queues.get((uid, f))
+        if entry and not force and not entry["stale"] and now - entry["built_at"] < CANDIDATE_QUEUE_MAX_AGE:
+            continue
+        gen = candidate_queue_gen.get(uid, 0)
+        # seen_cache and hidden_user_ids are only touched on the loop; the thread gets the entry and a copy
+        ids = await asyncio.to_thread(build_find_candidates, user, f, load_seen_filter(uid), set(hidden_user_ids))
+        store_candidate_queue(user, f, ids, gen)
+
+async def job_refresh_candidate_queues(context: ContextTypes.DEFAULT_TYPE):
+    # one-off warmup for a single user (scheduled from the Find Match menu)
+    if context.job and context.job.data:
+        await refresh_candidate_queues_for(int(context.job.data))
+        return
+
+    now = time.monotonic()
+    for uid, last_seen in list(candidate_queue_owners.items()):
+        if now - last_seen > CANDIDATE_QUEUE_ACTIVE_WINDOW:
+            candidate_queue_owners.pop(uid, None)
+            invalidate_candidate_queues(uid)
+            continue
+        try:
+            await refresh_candidate_queues_for(uid)
+        except Exception as e:
+            logger.warning("Candidate queue refresh failed for %s: %s", uid, e)
+
 async def send_match_card(chat_id: int, context: ContextTypes.DEFAULT_TYPE, target: User):
     kb = InlineKeyboardMarkup([
         [
@@ -302,42 +1381,294 @@ async def send_match_card(chat_id: int, context: ContextTypes.DEFAULT_TYPE, targ
     ])
 
     cap = profile_caption(target, show_username=False)  # other user's username hidden
+
+    # swap the previous card in place; a new message only for the first card or if editing fails
+    card_msg_id = context.user_data.get("fm_card_msg_id")
+    if card_msg_id and target.profile_picture_file_id:
+        try:
+            await context.bot.edit_message_media(
+                chat_id=chat_id, message_id=card_msg_id,
+                media=InputMediaPhoto(target.profile_picture_file_id, caption=cap), reply_markup=kb
+            )
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            logger.info("Card edit failed, sending new card: %s", e)
+
     if target.profile_picture_file_id:
-        await context.bot.send_photo(chat_id=chat_id, photo=target.profile_picture_file_id, caption=cap, reply_markup=kb)
+        msg = await context.bot.send_photo(chat_id=chat_id, photo=target.profile_picture_file_id, caption=cap, reply_markup=kb)
     else:
-        await context.bot.send_message(chat_id=chat_id, text=cap, reply_markup=kb)
+        msg = await context.bot.send_message(chat_id=chat_id, text=cap, reply_markup=kb)
+    context.user_data["fm_card_msg_id"] = msg.message_id
 
-async def show_next_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    uid = update.effective_user.id
+FIND_READ_AHEAD = 10  # profiles hydrated per query while browsing
+
+def hydrate_profiles(telegram_ids: List[int]) -> Dict[int, User]:
+    if not telegram_ids:
+        return {}
     session = db_session()
     try:
-        current = session.query(User).filter_by(telegram_id=uid).first()
-        if not current or not current.is_registered:
-            await update.effective_message.reply_text("Create a profile first /start")
-            return ConversationHandler.END
+        users = session.query(User).filter(User.telegram_id.in_(telegram_ids)).all()
+        return {u.telegram_id: u for u in users}
+    finally:
+        session.close()
 
-        candidates: List[int] = context.user_data.get("fm_candidates", [])
-        pos: int = int(context.user_data.get("fm_pos", 0))
+def reset_find_session(context: ContextTypes.DEFAULT_TYPE, candidates: Optional[List[int]] = None):
+    context.user_data.pop("fm_card_msg_id", None)
+    if candidates is None:
+        for key in ("fm_candidates", "fm_pos", "fm_buffer", "fm_deferred"):
+            context.user_data.pop(key, None)
+        return
+    context.user_data["fm_candidates"] = candidates
+    context.user_data["fm_pos"] = 0
+    context.user_data["fm_buffer"] = {}
+    context.user_data["fm_deferred"] = []
 
-        if pos >= len(candidates):
-            await update.effective_message.reply_text(
-                "No more profiles found yet. Try later or change filters",
-                reply_markup=main_menu_kb()
-            )
+async def show_next_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # The current user was validated when the filter was chosen (cb_find_filter); cards come
+    # from a read-ahead buffer filled FIND_READ_AHEAD at a time, so most taps hit no DB.
+    # The queue may predate recent views: profiles seen since are deferred as they come up
+    # and shown after the rest, instead of re-ranking the whole queue up front.
+    candidates: List[int] = context.user_data.get("fm_candidates", [])
+    pos: int = int(context.user_data.get("fm_pos", 0))
+    buffer: Dict[int, Optional[User]] = context.user_data.setdefault("fm_buffer", {})
+    deferred: List[int] = context.user_data.setdefault("fm_deferred", [])
+    seen = load_seen_filter(update.effective_user.id)
+
+    while pos < len(candidates) + len(deferred):
+        if pos < len(candidates):
+            ahead, i = candidates, pos
+            if has_seen(seen, candidates[pos]):
+                deferred.append(candidates[pos])
+                pos += 1
+                continue
+        else:
+            ahead, i = deferred, pos - len(candidates)
+        target_id = ahead[i]
+        if target_id not in buffer:
+            chunk = ahead[i:i + FIND_READ_AHEAD]
+            found = hydrate_profiles(chunk)
+            for tid in chunk:
+                buffer[tid] = found.get(tid)  # None marks deleted profiles
+        pos += 1
+
+        target = buffer.pop(target_id, None)
+        # queues and running sessions may predate a hide (auto-hide or admin), so check at serve time
+        if target and target.is_registered and target_id not in hidden_user_ids:
+            context.user_data["fm_pos"] = pos
+            context.user_data["fm_current"] = target_id
+            await send_match_card(update.effective_chat.id, context, target)
+            mark_seen(update.effective_user.id, target_id)
+            log_event("view", update.effective_user.id, target_id, f=context.user_data.get("fm_filter"))
+            return ST_FIND_BROWSE
+
+    context.user_data["fm_pos"] = pos
+    text = "No more profiles found yet. Try later or change filters"
+    card_msg_id = context.user_data.pop("fm_card_msg_id", None)
+    if card_msg_id:
+        try:
+            await context.bot.edit_message_caption(chat_id=update.effective_chat.id, message_id=card_msg_id, caption=text)
             return ConversationHandler.END
+        except BadRequest:
+            pass
+    await update.effective_message.reply_text(text, reply_markup=main_menu_kb())
+    return ConversationHandler.END
 
-        target_id = candidates[pos]
-        context.user_data["fm_pos"] = pos + 1
+# ----------------- ACTIVITY + ARCHIVAL -----------------
+# last_active_at is coalesced in memory (one entry per user, whatever the update rate)
+# and written in one executemany per flush. Users idle for ARCHIVE_AFTER_DAYS are
+# moved to users_archive so candidate scans and broadcasts never see them.
+ACTIVITY_FLUSH_INTERVAL = 60
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_INTERVAL = 24 * 3600
 
-        target = session.query(User).filter_by(telegram_id=target_id).first()
-        if not target:
-            return await show_next_match(update, context)
+activity_buffer: Dict[int, datetime.datetime] = {}  # telegram_id -> last update seen
 
-        await send_match_card(update.effective_chat.id, context, target)
-        return ST_FIND_BROWSE
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        activity_buffer[update.effective_user.id] = datetime.datetime.utcnow()
+
+def flush_activity():
+    if not activity_buffer:
+        return
+    items = list(activity_buffer.items())
+    activity_buffer.clear()
+    t = User.__table__
+    session = db_session()
+    try:
+        # updated_at pinned to itself so activity doesn't count as a profile change
+        session.execute(
+            sa_update(t).where(t.c.telegram_id == bindparam("tid"))
+            .values(last_active_at=bindparam("ts"), updated_at=t.c.updated_at),
+            [{"tid": tid, "ts": ts} for tid, ts in items]
+        )
+        session.commit()
+    except Exception:
+        for tid, ts in items:
+            activity_buffer.setdefault(tid, ts)
+        raise
     finally:
         session.close()
 
+async def job_flush_activity(context: ContextTypes.DEFAULT_TYPE):
+    flush_activity()
+
+def archived_columns() -> List[str]:
+    # users.id is not carried over: SQLite reuses freed rowids, so an archived id may
+    # belong to someone else by the time the row moves back. Rows are keyed by telegram_id.
+    return [c.name for c in User.__table__.columns if c.name != "id"]
+
+def archive_users(session, telegram_ids: List[int]):
+    cols = archived_columns()
+    session.execute(
+        UsersArchive.insert().prefix_with("OR REPLACE").from_select(
+            cols, select(*(User.__table__.c[c] for c in cols)).where(User.telegram_id.in_(telegram_ids))
+        )
+    )
+    session.query(User).filter(User.telegram_id.in_(telegram_ids)).delete(synchronize_session=False)
+
+def restore_archived_user(session, telegram_id: int) -> bool:
+    """Moves an archived row back into users; the caller's session is committed here."""
+    cols = archived_columns()
+    restored = session.execute(
+        User.__table__.insert().from_select(
+            cols, select(*(UsersArchive.c[c] for c in cols)).where(UsersArchive.c.telegram_id == telegram_id)
+        )
+    ).rowcount
+    if not restored:
+        return False
+    session.execute(UsersArchive.delete().where(UsersArchive.c.telegram_id == telegram_id))
+    session.execute(
+        sa_update(User.__table__).where(User.__table__.c.telegram_id == telegram_id)
+        .values(last_active_at=datetime.datetime.utcnow(), updated_at=User.__table__.c.updated_at)
+    )
+    session.commit()
+    logger.info("Restored archived user %s", telegram_id)
+    if CANDIDATE_INDEX is not None:
+        u = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if u:
+            CANDIDATE_INDEX.upsert(u)
+    mark_candidate_queues_stale()
+    return True
+
+async def job_archive_inactive_users(context: ContextTypes.DEFAULT_TYPE):
+    flush_activity()  # don't archive anyone whose activity is still only in memory
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    archived_ids: List[int] = []
+
+    def apply(session, ids):
+        archive_users(session, ids)
+        archived_ids.extend(ids)
+
+    archived = await run_in_batches(
+        lambda s: s.query(User.telegram_id).filter(User.last_active_at < cutoff),
+        apply,
+    )
+    if not archived:
+        return
+    for tid in archived_ids:
+        if CANDIDATE_INDEX is not None:
+            CANDIDATE_INDEX.remove(tid)
+        activity_buffer.pop(tid, None)
+    invalidate_candidate_queues(*archived_ids)
+    mark_candidate_queues_stale()
+    logger.info("Archived %s inactive users", archived)
+
+# ----------------- CALLBACK DEDUP -----------------
+# Double taps deliver the same callback twice. For buttons that write or send, the
+# repeat within CALLBACK_DEDUP_WINDOW is answered at once and dropped (group -2, so
+# it isn't charged by the throttle either). Browse buttons like fm:skip are not listed:
+# the card is edited in place, so quick legitimate taps share a message id.
+CALLBACK_DEDUP_WINDOW = 3.0  # seconds
+CALLBACK_DEDUP_PREFIXES = (
+    "rq:accept:", "rq:reject:", "m:free:", "m:pay:",
+    "fm:like:", "fm:dislike:", "fm:report:", "del:",
+    "admin:rep_review:", "admin:triage_hide:", "admin:triage_unhide:",
+)
+
+callback_seen: "OrderedDict[Tuple[int, str, int], float]" = OrderedDict()  # key -> expiry, oldest first
+
+async def dedup_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not q or not q.data or not q.data.startswith(CALLBACK_DEDUP_PREFIXES):
+        return
+
+    now = time.monotonic()
+    # entries share one window, so insertion order is expiry order
+    while callback_seen:
+        key, expires = next(iter(callback_seen.items()))
+        if expires > now:
+            break
+        callback_seen.popitem(last=False)
+
+    key = (q.from_user.id, q.data, q.message.message_id if q.message else 0)
+    if key in callback_seen:
+        await q.answer()
+        raise ApplicationHandlerStop
+    callback_seen[key] = now + CALLBACK_DEDUP_WINDOW
+
+# ----------------- THROTTLE -----------------
+# Per-user token bucket checked before any handler (group -1). Actions cost what they
+# cost the DB: a Find Match filter tap rebuilds a candidate list, a browse tap is cheap.
+# Over budget, the update is dropped with ApplicationHandlerStop and the user gets at
+# most one cooldown notice per wait.
+THROTTLE_RATE = 1.0       # tokens per second
+THROTTLE_BURST = 10.0
+THROTTLE_CALLBACK_COSTS = (  # first matching prefix wins
+    ("fm:filter:", 4.0),
+    ("rq:", 2.0),
+    ("m:pay:", 3.0),
+    ("admin:", 0.0),
+)
+THROTTLE_TEXT_COSTS = {"Find Match": 2.0, "Requests": 3.0, "Refer 3 users to unlock 1 username": 2.0}
+
+throttle_buckets: Dict[int, TokenBucket] = {}
+throttle_notified: Dict[int, float] = {}  # telegram_id -> when the cooldown notice may repeat
+
+def update_cost(update: Update) -> float:
+    if update.pre_checkout_query or (update.effective_message and update.effective_message.successful_payment):
+        return 0.0  # never drop payments
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        for prefix, cost in THROTTLE_CALLBACK_COSTS:
+            if data.startswith(prefix):
+                return cost
+        return 1.0
+    if update.effective_message and update.effective_message.text:
+        return THROTTLE_TEXT_COSTS.get(update.effective_message.text.strip(), 1.0)
+    return 1.0
+
+async def throttle_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or is_admin(user.id):
+        return
+    cost = update_cost(update)
+    if not cost:
+        return
+
+    now = time.monotonic()
+    bucket = throttle_buckets.get(user.id)
+    if bucket is None:
+        bucket = throttle_buckets[user.id] = TokenBucket(THROTTLE_RATE, THROTTLE_BURST)
+    if bucket.take(now, cost):
+        return
+
+    wait = max(1, round(bucket.wait_time(now, cost)))
+    if update.callback_query:
+        await update.callback_query.answer(f"⏳ Slow down, try again in {wait}s")
+    elif throttle_notified.get(user.id, 0) <= now and update.effective_message:
+        await update.effective_message.reply_text(f"⏳ Too many actions. Please wait {wait}s and try again.")
+    throttle_notified[user.id] = now + wait
+    raise ApplicationHandlerStop
+
+async def job_prune_throttle(context: ContextTypes.DEFAULT_TYPE):
+    # a bucket idle long enough to refill completely carries no state
+    idle = time.monotonic() - THROTTLE_BURST / THROTTLE_RATE
+    for uid in [u for u, b in throttle_buckets.items() if b.stamp < idle]:
+        throttle_buckets.pop(uid, None)
+        throttle_notified.pop(uid, None)
+
 # ----------------- START + MENUS -----------------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = upsert_user_from_telegram(update)
@@ -521,6 +1852,34 @@ async def st_create_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     return ST_CREATE_PHOTO
 
+def credit_referral(session, referred_uid: int) -> Optional[int]:
+    """Counts a completed referral exactly once; returns the referrer's new referral_count.
+    Plain SQL increments so concurrent signups under one referrer never lose a count."""
+    ref_id = session.execute(
+        sa_update(User)
+        .where(
+            User.telegram_id == referred_uid,
+            User.referred_by_id.isnot(None),
+            func.coalesce(User.referral_counted, False) == False,
+        )
+        .values(referral_counted=True)
+        .returning(User.referred_by_id)
+    ).scalar()
+    if ref_id is None:
+        return None
+
+    # every 3 successful referrals -> +1 free unlock (right-hand sides see the old row)
+    count = func.coalesce(User.referral_count, 0)
+    return session.execute(
+        sa_update(User)
+        .where(User.telegram_id == ref_id)
+        .values(
+            referral_count=count + 1,
+            free_unlocks=func.coalesce(User.free_unlocks, 0) + ((count + 1) % 3 == 0).cast(Integer),
+        )
+        .returning(User.referral_count)
+    ).scalar()
+
 async def st_create_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not update.effective_message.photo:
         await update.effective_message.reply_text("Upload Photo (profile picture):")
@@ -543,22 +1902,20 @@ async def st_create_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         user.country = context.user_data.get("country")
         user.profile_picture_file_id = file_id
         user.is_registered = True
-        user.referral_counted = user.referral_counted or False
+        if user.registered_at is None:
+            user.registered_at = datetime.datetime.utcnow()
+        session.flush()
 
         # Successful referral counting happens HERE (when profile completed)
-        if user.referred_by_id and not user.referral_counted:
-            ref = session.query(User).filter_by(telegram_id=user.referred_by_id).first()
-            if ref:
-                ref.referral_count += 1
-                # every 3 successful referrals -> +1 free unlock
-                if ref.referral_count % 3 == 0:
-                    ref.free_unlocks += 1
-                user.referral_counted = True
+        credit_referral(session, user.telegram_id)
 
         session.commit()
     finally:
         session.close()
 
+    sync_candidate_index(update.effective_user.id)
+    mark_candidate_queues_stale(context.user_data.get("country"))
+
     await update.effective_message.reply_text("✅ Profile creation done!", reply_markup=main_menu_kb())
     return ConversationHandler.END
 
@@ -640,6 +1997,7 @@ async def st_edit_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     finally:
         session.close()
 
+    sync_candidate_index(update.effective_user.id)
     await update.effective_message.reply_text("✅ Age updated!", reply_markup=main_menu_kb())
     return ConversationHandler.END
 
@@ -653,12 +2011,18 @@ async def st_edit_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     session = db_session()
     try:
         user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
+        country = None
         if user:
             user.gender = gender
+            country = user.country
             session.commit()
     finally:
         session.close()
 
+    sync_candidate_index(update.effective_user.id)
+    invalidate_candidate_queues(update.effective_user.id)
+    mark_candidate_queues_stale(country)
+
     await update.effective_message.reply_text("✅ Gender updated!", reply_markup=main_menu_kb())
     return ConversationHandler.END
 
@@ -700,6 +2064,10 @@ async def st_edit_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     finally:
         session.close()
 
+    sync_candidate_index(update.effective_user.id)
+    invalidate_candidate_queues(update.effective_user.id)
+    mark_candidate_queues_stale(country or "Unknown")
+
     await update.effective_message.reply_text("✅ Location updated!", reply_markup=main_menu_kb())
     return ConversationHandler.END
 
@@ -735,6 +2103,11 @@ async def menu_find_match(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         [InlineKeyboardButton("Back", callback_data="back:main")],
     ])
     await update.effective_message.reply_text("Choose filter:", reply_markup=kb)
+
+    # warm the candidate queues while the user picks a filter
+    touch_candidate_queue_owner(user.telegram_id)
+    if context.job_queue:
+        context.job_queue.run_once(job_refresh_candidate_queues, 0, data=user.telegram_id)
     return ST_FIND_FILTER
 
 async def cb_find_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -753,22 +2126,25 @@ async def cb_find_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     finally:
         session.close()
 
-    candidates = build_find_candidates(get_user(q.from_user.id), gender_filter)
-    context.user_data["fm_candidates"] = candidates
-    context.user_data["fm_pos"] = 0
+    touch_candidate_queue_owner(current.telegram_id)
+    candidates = take_candidate_queue(current.telegram_id, gender_filter)
+    if candidates is None:
+        candidates = build_find_candidates(current, gender_filter, load_seen_filter(current.telegram_id), hidden_user_ids)
+        store_candidate_queue(current, gender_filter, candidates)
+    reset_find_session(context, candidates)
     context.user_data["fm_filter"] = gender_filter
 
-    await q.message.reply_text(f"Filter set: {gender_filter}. Profiles loading...")
+    await edit_or_reply(q.message, f"Filter set: {gender_filter}. Profiles loading...")
     return await show_next_match(update, context)
 
 async def cb_find_browse(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
-    await q.answer()
-
     data = q.data
     uid = q.from_user.id
 
     if data == "fm:skip":
+        log_event("skip", uid, context.user_data.get("fm_current"))
+        await q.answer()
         return await show_next_match(update, context)
 
     if data.startswith("fm:dislike:"):
@@ -782,12 +2158,15 @@ async def cb_find_browse(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 session.commit()
         finally:
             session.close()
-        await q.message.reply_text("👎 Disliked. Next profile:")
+        invalidate_candidate_queues(uid)
+        log_event("dislike", uid, target_id)
+        await q.answer("👎 Disliked")
         return await show_next_match(update, context)
 
     if data.startswith("fm:like:"):
         target_id = int(data.split(":")[2])
         context.user_data["like_target_id"] = target_id
+        log_event("like", uid, target_id)
 
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("Friendship", callback_data="fm:purpose:Friendship")],
@@ -795,7 +2174,8 @@ async def cb_find_browse(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             [InlineKeyboardButton("Other purpose", callback_data="fm:purpose:Other")],
             [InlineKeyboardButton("Cancel", callback_data="fm:purpose:cancel")],
         ])
-        await q.message.reply_text("Liked it ✅ Now choose your purpose:", reply_markup=kb)
+        await q.answer()
+        await edit_or_reply(q.message, f"{message_body(q.message)}\nLiked it ✅ Now choose your purpose:", kb)
         return ST_FIND_PURPOSE
 
     if data.startswith("fm:report:"):
@@ -810,24 +2190,26 @@ async def cb_find_browse(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             [InlineKeyboardButton("Other", callback_data="fm:report_reason:Other")],
             [InlineKeyboardButton("Cancel", callback_data="fm:report_reason:cancel")],
         ])
-        await q.message.reply_text("Select Report reason:", reply_markup=kb)
+        await q.answer()
+        await edit_or_reply(q.message, f"{message_body(q.message)}\nSelect Report reason:", kb)
         return ST_FIND_REPORT_REASON
 
+    await q.answer()
     return ST_FIND_BROWSE
 
 async def cb_find_purpose(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
-    await q.answer()
 
     purpose = q.data.split(":", 2)[2]
     if purpose == "cancel":
-        await q.message.reply_text("Canceled. Next profile:")
+        log_event("like_cancel", q.from_user.id, context.user_data.get("like_target_id"))
+        await q.answer("Canceled")
         return await show_next_match(update, context)
 
     requester_id = q.from_user.id
     target_id = context.user_data.get("like_target_id")
     if not target_id:
-        await q.message.reply_text("Error. Try again.")
+        await q.answer("Error. Try again.")
         return await show_next_match(update, context)
 
     session = db_session()
@@ -835,52 +2217,78 @@ async def cb_find_purpose(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Already exists request?
         existing = session.query(MatchRequest).filter_by(requester_id=requester_id, target_id=target_id).first()
         if existing and existing.status in ["Pending", "Accepted"]:
-            await q.message.reply_text("You have already sent a request. Next profileile:")
+            await q.answer("You have already sent a request.")
             return await show_next_match(update, context)
 
-        # Create request
-        req = MatchRequest(requester_id=requester_id, target_id=target_id, purpose=purpose, status="Pending")
-        session.add(req)
-        session.commit()
+        # Mutual like: the target already asked us (uq_req index lookup), so match right away
+        # instead of creating a mirror request that both sides would handle in the inbox.
+        reciprocal_id = session.query(MatchRequest.id).filter_by(
+            requester_id=target_id, target_id=requester_id, status="Pending"
+        ).scalar()
+        if reciprocal_id:
+            accepted = accept_match_request(session, reciprocal_id, requester_id)
+            if accepted:
+                match_id, _ = accepted
+                notify_match_created(session, match_id, target_id, requester_id)
+                session.commit()
+                invalidate_candidate_queues(requester_id, target_id)
+                kick_outbox(context)
+                log_event("match", requester_id, target_id, p=purpose, m=match_id, via="mutual")
+                await q.answer("🎉 It's a match! You liked each other.")
+                return await show_next_match(update, context)
+
+        # Create request (an old Rejected/Expired row for this pair is reused, uq_req allows only one)
+        if existing:
+            req = existing
+            req.purpose = purpose
+            req.status = "Pending"
+            req.created_at = datetime.datetime.utcnow()
+        else:
+            req = MatchRequest(requester_id=requester_id, target_id=target_id, purpose=purpose, status="Pending")
+            session.add(req)
+        session.flush()
 
         requester = session.query(User).filter_by(telegram_id=requester_id).first()
         target = session.query(User).filter_by(telegram_id=target_id).first()
 
-        # notify target
+        # notify target (delivered by the outbox dispatcher)
         if target:
-            await context.bot.send_message(
-                chat_id=target.telegram_id,
-                text=(
-                    "🔔 New Request received!\n\n"
-                    f"From: {requester.name if requester else requester_id}\n"
-                    f"Purpose: {purpose}\n\n"
-                    "To view requests Main Menu -> Requests"
-                ),
-                reply_markup=main_menu_kb()
+            enqueue_notification(
+                session, target.telegram_id,
+                "🔔 New Request received!\n\n"
+                f"From: {requester.name if requester else requester_id}\n"
+                f"Purpose: {purpose}\n\n"
+                "To view requests Main Menu -> Requests",
+                main_menu=True,
+                dedup_key=f"req:{req.id}:{req.created_at:%Y%m%d%H%M%S}"
             )
+        session.commit()
+        invalidate_candidate_queues(requester_id)  # the target keeps the requester in its queue
+        kick_outbox(context)
+        log_event("request", requester_id, target_id, p=purpose)
 
-        await q.message.reply_text("✅ Request sent. Next profile:")
+        await q.answer("✅ Request sent")
         return await show_next_match(update, context)
     finally:
         session.close()
 
 async def cb_find_report_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
-    await q.answer()
 
     reason = q.data.split(":", 2)[2]
     if reason == "cancel":
-        await q.message.reply_text("Report canceled. Next profile:")
+        await q.answer("Report canceled")
         return await show_next_match(update, context)
 
     if reason == "Other":
+        await q.answer()
         await q.message.reply_text("Write other reason:")
         context.user_data["report_reason_base"] = "Other"
         return ST_FIND_REPORT_TEXT
 
     # save report directly
     await save_report_and_block(update, context, reason)
-    await q.message.reply_text("✅ Report sent. Next profile:")
+    await q.answer("✅ Report sent")
     return await show_next_match(update, context)
 
 async def st_find_report_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -888,6 +2296,7 @@ async def st_find_report_text(update: Update, context: ContextTypes.DEFAULT_TYPE
     reason = f"Other: {text}" if text else "Other"
     await save_report_and_block(update, context, reason)
     await update.effective_message.reply_text("✅ Report sent. Next profile:")
+    context.user_data.pop("fm_card_msg_id", None)  # the old card is now above the chat; start a new one
     return await show_next_match(update, context)
 
 async def save_report_and_block(update: Update, context: ContextTypes.DEFAULT_TYPE, reason: str):
@@ -898,126 +2307,242 @@ async def save_report_and_block(update: Update, context: ContextTypes.DEFAULT_TY
 
     session = db_session()
     try:
+        newly_hidden = record_report_stat(session, reporter_id, reported_id)
         session.add(Report(reporter_id=reporter_id, reported_id=reported_id, reason=reason, status="Pending"))
         # also block so it won't appear again
         exists = session.query(BlockedProfile).filter_by(blocker_id=reporter_id, blocked_id=reported_id).first()
         if not exists:
             session.add(BlockedProfile(blocker_id=reporter_id, blocked_id=reported_id))
+        # the admin hears about it in the next report digest (job_report_digest)
         session.commit()
     finally:
         session.close()
-
-    # notify admin
-    if ADMIN_TELEGRAM_ID:
-        await context.bot.send_message(
-            chat_id=ADMIN_TELEGRAM_ID,
-            text=f"🚩 New Report\nReporter: {reporter_id}\nReported: {reported_id}\nReason: {reason}"
-        )
+    invalidate_candidate_queues(reporter_id)
+    log_event("report", reporter_id, reported_id, r=reason)
+    if newly_hidden:
+        set_user_hidden(reported_id, True)
+        logger.info("User %s hidden after %s distinct reports", reported_id, REPORT_HIDE_THRESHOLD)
 
 # ----------------- REQUESTS -----------------
-async def menu_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
+def pending_request_at(uid: int, offset: int):
+    """Returns (total, offset, (request, sender)) for one page of the inbox, newest first."""
     session = db_session()
     try:
-        reqs = session.query(MatchRequest).filter_by(target_id=uid, status="Pending").order_by(MatchRequest.created_at.desc()).all()
-        if not reqs:
-            await update.effective_message.reply_text("No pending requests.", reply_markup=main_menu_kb())
-            return
-
-        await update.effective_message.reply_text(f"Pending requests: {len(reqs)}")
+        base = session.query(MatchRequest, User).join(User, User.telegram_id == MatchRequest.requester_id).filter(
+            MatchRequest.target_id == uid, MatchRequest.status == "Pending"
+        )
+        total = base.count()
+        if not total:
+            return 0, 0, None
+        offset = max(0, min(offset, total - 1))
+        row = base.order_by(MatchRequest.created_at.desc()).offset(offset).limit(1).first()
+        return total, offset, row
+    finally:
+        session.close()
 
-        for r in reqs:
-            sender = session.query(User).filter_by(telegram_id=r.requester_id).first()
-            if not sender:
-                continue
+async def show_request_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int, uid: int, offset: int,
+                            message: Optional[Message] = None):
+    """Renders the requests inbox as one card, edited in place while paging/accepting/rejecting."""
+    total, offset, row = pending_request_at(uid, offset)
+    if not row:
+        if message:
+            await edit_or_reply(message, "No pending requests.", fallback_markup=main_menu_kb())
+        else:
+            await context.bot.send_message(chat_id=chat_id, text="No pending requests.", reply_markup=main_menu_kb())
+        return
 
-            cap = profile_caption(sender, show_username=False) + f"🎯 Purpose: {r.purpose}\n"
-            kb = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("Accept ✅", callback_data=f"rq:accept:{r.id}"),
-                    InlineKeyboardButton("Reject ❌", callback_data=f"rq:reject:{r.id}"),
-                ]
-            ])
-            if sender.profile_picture_file_id:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=sender.profile_picture_file_id,
-                    caption=cap,
-                    reply_markup=kb
-                )
+    r, sender = row
+    cap = profile_caption(sender, show_username=False) + f"🎯 Purpose: {r.purpose}\n\n📨 Request {offset + 1} of {total}"
+    rows = [[
+        InlineKeyboardButton("Accept ✅", callback_data=f"rq:accept:{r.id}:{offset}"),
+        InlineKeyboardButton("Reject ❌", callback_data=f"rq:reject:{r.id}:{offset}"),
+    ]]
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"rq:page:{offset - 1}"))
+    if offset + 1 < total:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"rq:page:{offset + 1}"))
+    if nav:
+        rows.append(nav)
+    kb = InlineKeyboardMarkup(rows)
+
+    if message:
+        try:
+            if sender.profile_picture_file_id and message.photo:
+                await message.edit_media(InputMediaPhoto(sender.profile_picture_file_id, caption=cap), reply_markup=kb)
             else:
-                await update.effective_message.reply_text(cap, reply_markup=kb)
+                await message.edit_text(cap, reply_markup=kb)
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            logger.info("Request card edit failed, sending new card: %s", e)
 
-    finally:
-        session.close()
+    if sender.profile_picture_file_id:
+        await context.bot.send_photo(chat_id=chat_id, photo=sender.profile_picture_file_id, caption=cap, reply_markup=kb)
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=cap, reply_markup=kb)
 
-async def cb_request_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def menu_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_request_card(context, update.effective_chat.id, update.effective_user.id, 0)
+
+async def cb_request_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
+    offset = context.args[0]
+    await show_request_card(context, q.message.chat_id, q.from_user.id, offset, q.message)
+
+def accept_match_request(session, req_id: int, target_uid: int) -> Optional[Tuple[int, int]]:
+    """Accepts a pending request and creates the match as one write in the caller's transaction.
+    Returns (match_id, requester_id), or None if the request is not pending for target_uid."""
+    row = session.execute(
+        sa_update(MatchRequest)
+        .where(MatchRequest.id == req_id, MatchRequest.target_id == target_uid, MatchRequest.status == "Pending")
+        .values(status="Accepted")
+        .returning(MatchRequest.requester_id, MatchRequest.purpose)
+    ).first()
+    if not row:
+        return None
+
+    u1, u2 = canonical_pair(row.requester_id, target_uid)
+    match_id = session.execute(
+        sqlite_insert(Match)
+        .values(user1_id=u1, user2_id=u2, purpose=row.purpose)
+        .on_conflict_do_nothing(index_elements=["user1_id", "user2_id"])
+        .returning(Match.id)
+    ).scalar()
+    if match_id is None:
+        # the crossing request was accepted first; reuse its match
+        match_id = session.query(Match.id).filter_by(user1_id=u1, user2_id=u2).scalar()
+    return match_id, row.requester_id
+
+async def cb_request_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
 
-    action = q.data.split(":")[1]
-    req_id = int(q.data.split(":")[2])
+    action = "reject" if q.data.startswith("rq:reject:") else "accept"
+    req_id, offset = (context.args + [0])[:2]
     uid = q.from_user.id
 
     session = db_session()
     try:
-        req = session.query(MatchRequest).filter_by(id=req_id).first()
-        if not req or req.target_id != uid or req.status != "Pending":
-            await q.message.reply_text("Invalid/expired request.")
-            return
-
-        requester = session.query(User).filter_by(telegram_id=req.requester_id).first()
-        target = session.query(User).filter_by(telegram_id=req.target_id).first()
-        if not requester or not target:
-            await q.message.reply_text("User not found.")
-            return
-
         if action == "reject":
-            req.status = "Rejected"
+            row = session.execute(
+                sa_update(MatchRequest)
+                .where(MatchRequest.id == req_id, MatchRequest.target_id == uid, MatchRequest.status == "Pending")
+                .values(status="Rejected")
+                .returning(MatchRequest.requester_id, MatchRequest.created_at)
+            ).first()
+            if not row:
+                await q.answer("Invalid/expired request.")
+                await show_request_card(context, q.message.chat_id, uid, offset, q.message)
+                return
+            enqueue_notification(
+                session, row.requester_id, "Your request was rejected.",
+                dedup_key=f"rej:{req_id}:{row.created_at:%Y%m%d%H%M%S}"
+            )
             session.commit()
-            await q.message.reply_text("❌ Request rejected.")
-            await context.bot.send_message(chat_id=requester.telegram_id, text="Your request was rejected.")
+            invalidate_candidate_queues(row.requester_id, uid)
+            kick_outbox(context)
+            log_event("reject", uid, row.requester_id)
+            await q.answer("❌ Request rejected.")
+            await show_request_card(context, q.message.chat_id, uid, offset, q.message)
             return
 
-        # accept
-        req.status = "Accepted"
-        u1, u2 = canonical_pair(requester.telegram_id, target.telegram_id)
-        match = session.query(Match).filter_by(user1_id=u1, user2_id=u2).first()
-        if not match:
-            match = Match(user1_id=u1, user2_id=u2, purpose=req.purpose)
-            session.add(match)
-            session.commit()
-            session.refresh(match)
-        else:
-            session.commit()
-
-        await q.message.reply_text("✅ Match successful!")
+        # accept: guarded status flip + match insert + notifications, one commit
+        accepted = accept_match_request(session, req_id, uid)
+        if not accepted:
+            await q.answer("Invalid/expired request.")
+            await show_request_card(context, q.message.chat_id, uid, offset, q.message)
+            return
+        match_id, requester_id = accepted
+        notify_match_created(session, match_id, requester_id, uid)
+        session.commit()
+        invalidate_candidate_queues(requester_id, uid)
+        kick_outbox(context)
+        log_event("match", uid, requester_id, m=match_id, via="accept")
 
-        # notify both sides with unlock options
-        await notify_match_created(context, match.id, requester.telegram_id, target.telegram_id)
+        await q.answer("✅ Match successful!")
+        await show_request_card(context, q.message.chat_id, uid, offset, q.message)
 
     finally:
         session.close()
 
-async def notify_match_created(context: ContextTypes.DEFAULT_TYPE, match_id: int, a: int, b: int):
-    # send to user a
+def notify_match_created(session, match_id: int, a: int, b: int):
+    """Queues the match message with unlock options for both users in the caller's transaction."""
     for uid in [a, b]:
-        u = get_user(uid)
+        u = session.query(User).filter_by(telegram_id=uid).first()
         if not u:
             continue
 
         kb_rows = [[InlineKeyboardButton("Unlock Username (7 Stars ⭐)", callback_data=f"m:pay:{match_id}")]]
         if u.free_unlocks and u.free_unlocks > 0:
             kb_rows.insert(0, [InlineKeyboardButton("Use Free Unlock 🎁", callback_data=f"m:free:{match_id}")])
-        kb_rows.append([InlineKeyboardButton("Later", callback_data="back:main")])
+        kb_rows.append([InlineKeyboardButton("Later", callback_data="m:later")])
 
         kb = InlineKeyboardMarkup(kb_rows)
-        await context.bot.send_message(
-            chat_id=uid,
-            text="🎉 Match successful!\nUsername unlocked to view:",
-            reply_markup=kb
+        enqueue_notification(
+            session, uid, "🎉 Match successful!\nUsername unlocked to view:",
+            reply_markup=kb, dedup_key=f"match:{match_id}:{uid}"
         )
 
+# --- Request expiry / compaction ---
+REQUEST_PENDING_TTL_DAYS = 30     # unanswered requests expire after this
+REQUEST_CLOSED_KEEP_DAYS = 30     # extra days Rejected/Expired rows are kept before deletion
+COMPACTION_BATCH = 500            # rows per transaction, keeps write locks short
+COMPACTION_INTERVAL = 3600
+
+async def run_in_batches(select_ids, apply) -> int:
+    """Runs apply(session, ids) over select_ids(session) in small committed batches."""
+    total = 0
+    while True:
+        session = db_session()
+        try:
+            ids = [r[0] for r in select_ids(session).limit(COMPACTION_BATCH).all()]
+            if ids:
+                apply(session, ids)
+                session.commit()
+        finally:
+            session.close()
+        if not ids:
+            return total
+        total += len(ids)
+        await asyncio.sleep(0)  # let handlers run between batches
+
+async def job_compact_requests(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.datetime.utcnow()
+    pending_cutoff = now - datetime.timedelta(days=REQUEST_PENDING_TTL_DAYS)
+    rejected_cutoff = now - datetime.timedelta(days=REQUEST_CLOSED_KEEP_DAYS)
+    expired_cutoff = pending_cutoff - datetime.timedelta(days=REQUEST_CLOSED_KEEP_DAYS)
+
+    expired = await run_in_batches(
+        lambda s: s.query(MatchRequest.id).filter(
+            MatchRequest.status == "Pending", MatchRequest.created_at < pending_cutoff
+        ),
+        lambda s, ids: s.query(MatchRequest).filter(MatchRequest.id.in_(ids)).update(
+            {MatchRequest.status: "Expired"}, synchronize_session=False
+        ),
+    )
+    deleted = await run_in_batches(
+        lambda s: s.query(MatchRequest.id).filter(or_(
+            and_(MatchRequest.status == "Rejected", MatchRequest.created_at < rejected_cutoff),
+            and_(MatchRequest.status == "Expired", MatchRequest.created_at < expired_cutoff),
+        )),
+        lambda s, ids: s.query(MatchRequest).filter(MatchRequest.id.in_(ids)).delete(synchronize_session=False),
+    )
+
+    context.bot_data["last_compaction"] = {"at": now, "expired": expired, "deleted": deleted}
+    if expired or deleted:
+        logger.info("Request compaction: %s expired, %s deleted", expired, deleted)
+        if expired:
+            mark_candidate_queues_stale()  # expired targets become eligible again
+
+# --- Username unlocks / payments ---
+UNLOCK_PRICE_STARS = 7
+PAYMENT_HISTORY_SIZE = 10
+MATCH_MEMBER_CACHE_MAX = 10000
+
+match_member_cache: Dict[int, Tuple[int, int]] = {}  # match_id -> (user1_id, user2_id)
+
 def other_user_in_match(match: Match, current_id: int) -> Optional[int]:
     if match.user1_id == current_id:
         return match.user2_id
@@ -1032,23 +2557,35 @@ def is_unlocked_for_user(match: Match, uid: int) -> bool:
         return bool(match.user2_unlocked)
     return False
 
-def set_unlocked_for_user(match: Match, uid: int):
-    if match.user1_id == uid:
-        match.user1_unlocked = True
-    elif match.user2_id == uid:
-        match.user2_unlocked = True
+def take_free_unlock(session, uid: int) -> Optional[int]:
+    """Spends one free unlock; returns how many are left, or None if there were none."""
+    return session.execute(
+        sa_update(User)
+        .where(User.telegram_id == uid, User.free_unlocks >= 1)
+        .values(free_unlocks=User.free_unlocks - 1)
+        .returning(User.free_unlocks)
+    ).scalar()
+
+def unlock_match_for_user(session, match_id: int, match: Match, uid: int) -> bool:
+    """Sets uid's unlocked flag only if it is still unset; False if someone got there first."""
+    col = Match.user1_unlocked if match.user1_id == uid else Match.user2_unlocked
+    return session.execute(
+        sa_update(Match)
+        .where(Match.id == match_id, func.coalesce(col, False) == False)
+        .values({col: True})
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
 
 async def cb_match_unlock_free(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    match_id = int(q.data.split(":")[2])
+    match_id = context.args[0]
     uid = q.from_user.id
 
     session = db_session()
     try:
         match = session.query(Match).filter_by(id=match_id).first()
-        user = session.query(User).filter_by(telegram_id=uid).first()
-        if not match or not user:
+        if not match:
             await q.message.reply_text("Invalid match.")
             return
 
@@ -1062,21 +2599,26 @@ async def cb_match_unlock_free(update: Update, context: ContextTypes.DEFAULT_TYP
             await q.message.reply_text(f"Already unlocked: @{other.username}" if other and other.username else "Already unlocked.")
             return
 
-        if not user.free_unlocks or user.free_unlocks < 1:
-            await q.message.reply_text("No free unlocks available.")
-            return
-
         other = session.query(User).filter_by(telegram_id=other_id).first()
         if not other or not other.username:
             await q.message.reply_text("Other user's username not available.")
             return
 
-        user.free_unlocks -= 1
-        set_unlocked_for_user(match, uid)
+        # guarded decrement + guarded flip: a double tap can't spend twice or unlock for free
+        left = take_free_unlock(session, uid)
+        if left is None:
+            await q.message.reply_text("No free unlocks available.")
+            return
+        if not unlock_match_for_user(session, match_id, match, uid):
+            session.rollback()
+            await q.message.reply_text(f"Already unlocked: @{other.username}")
+            return
         session.commit()
+        log_event("unlock", uid, other_id, m=match_id, via="free")
 
         await q.message.reply_text(
-            f"🎁 Free unlock used!\nUsername: @{other.username}\nChat: https://t.me/{other.username}",
+            f"🎁 Free unlock used!\nUsername: @{other.username}\nChat: https://t.me/{other.username}\n"
+            f"Free unlocks left: {left}",
             disable_web_page_preview=True
         )
     finally:
@@ -1085,7 +2627,7 @@ async def cb_match_unlock_free(update: Update, context: ContextTypes.DEFAULT_TYP
 async def cb_match_unlock_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    match_id = int(q.data.split(":")[2])
+    match_id = context.args[0]
     uid = q.from_user.id
 
     session = db_session()
@@ -1103,11 +2645,16 @@ async def cb_match_unlock_pay(update: Update, context: ContextTypes.DEFAULT_TYPE
         if is_unlocked_for_user(match, uid):
             await q.message.reply_text("Already unlocked.")
             return
+
+        # the partner may have been archived (match kept) or lost their username; don't charge for nothing
+        if not session.query(User.username).filter_by(telegram_id=other_id).scalar():
+            await q.message.reply_text("Other user's username not available.")
+            return
     finally:
         session.close()
 
     # Telegram Stars invoice (currency XTR, provider_token must be empty string)
-    prices = [LabeledPrice("Unlock username", 7)]
+    prices = [LabeledPrice("Unlock username", UNLOCK_PRICE_STARS)]
     payload = f"unlock:{match_id}:{uid}"
 
     await context.bot.send_invoice(
@@ -1120,57 +2667,135 @@ async def cb_match_unlock_pay(update: Update, context: ContextTypes.DEFAULT_TYPE
         prices=prices,
     )
 
+def parse_unlock_payload(payload: str) -> Optional[Tuple[int, int]]:
+    """"unlock:match_id:uid" -> (match_id, uid)"""
+    if not payload.startswith("unlock:"):
+        return None
+    try:
+        _, match_id_str, uid_str = payload.split(":", 2)
+        return int(match_id_str), int(uid_str)
+    except ValueError:
+        return None
+
+def match_members(match_id: int) -> Optional[Tuple[int, int]]:
+    """(user1_id, user2_id) of a match; cached since a match's members never change."""
+    if match_id in match_member_cache:
+        return match_member_cache[match_id]
+    session = db_session()
+    try:
+        row = session.query(Match.user1_id, Match.user2_id).filter_by(id=match_id).first()
+    finally:
+        session.close()
+    if not row:
+        return None
+    if len(match_member_cache) >= MATCH_MEMBER_CACHE_MAX:
+        match_member_cache.pop(next(iter(match_member_cache)))
+    match_member_cache[match_id] = (row.user1_id, row.user2_id)
+    return match_member_cache[match_id]
+
+def member_username(telegram_id: int) -> Optional[str]:
+    """Not cached: None once the member is archived/deleted or drops their username."""
+    session = db_session()
+    try:
+        return session.query(User.username).filter_by(telegram_id=telegram_id).scalar()
+    finally:
+        session.close()
+
 async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.pre_checkout_query
-    # Always approve (you can add validation)
+    # Telegram waits ~10s for this answer, so only cheap checks here
+    parsed = parse_unlock_payload(query.invoice_payload)
+    if not parsed or query.currency != "XTR" or query.total_amount != UNLOCK_PRICE_STARS:
+        await query.answer(ok=False, error_message="This invoice is no longer valid.")
+        return
+    match_id, uid = parsed
+    members = match_members(match_id)
+    if uid != query.from_user.id or not members or uid not in members:
+        await query.answer(ok=False, error_message="This match is no longer available.")
+        return
+    other_id = members[1] if members[0] == uid else members[0]
+    if not member_username(other_id):  # primary-key lookup, still cheap
+        await query.answer(ok=False, error_message="Other user's username not available.")
+        return
     await query.answer(ok=True)
 
+def record_payment(session, sp, telegram_id: int, match_id: Optional[int]) -> Optional[int]:
+    """Inserts the ledger row; returns its id, or None if this charge was already recorded."""
+    return session.execute(
+        sqlite_insert(Payment)
+        .values(
+            telegram_payment_charge_id=sp.telegram_payment_charge_id,
+            provider_payment_charge_id=sp.provider_payment_charge_id,
+            telegram_id=telegram_id,
+            match_id=match_id,
+            payload=sp.invoice_payload,
+            currency=sp.currency,
+            total_amount=sp.total_amount,
+        )
+        .on_conflict_do_nothing(index_elements=["telegram_payment_charge_id"])
+        .returning(Payment.id)
+    ).scalar()
+
+def settle_payment(session, payment_id: int, status: str, note: Optional[str] = None):
+    session.query(Payment).filter_by(id=payment_id).update(
+        {Payment.status: status, Payment.note: note}, synchronize_session=False
+    )
+
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     sp = update.effective_message.successful_payment
     payload = sp.invoice_payload  # "unlock:match_id:uid"
+    parsed = parse_unlock_payload(payload)
+    payer = update.effective_user.id
 
-    if not payload.startswith("unlock:"):
-        return
-
+    session = db_session()
     try:
-        _, match_id_str, uid_str = payload.split(":", 2)
-        match_id = int(match_id_str)
-        uid = int(uid_str)
-    except Exception:
-        return
+        # ledger first: a re-delivered update hits the unique charge id and stops here
+        payment_id = record_payment(session, sp, payer, parsed[0] if parsed else None)
+        if payment_id is None:
+            logger.info("Duplicate payment update %s ignored", sp.telegram_payment_charge_id)
+            return
 
-    # Validate amount/currency
-    if sp.currency != "XTR" or sp.total_amount != 7:
-        await update.effective_message.reply_text("Payment received but invalid amount/currency.")
-        return
+        async def reject(note: str, text: str):
+            settle_payment(session, payment_id, "Rejected", note)
+            session.commit()
+            logger.warning("Payment %s rejected: %s", sp.telegram_payment_charge_id, note)
+            await update.effective_message.reply_text(text)
+
+        if not parsed:
+            await reject("bad payload", "Payment received but the invoice was not recognised.")
+            return
+        match_id, uid = parsed
+
+        # Validate amount/currency
+        if sp.currency != "XTR" or sp.total_amount != UNLOCK_PRICE_STARS:
+            await reject("amount/currency", "Payment received but invalid amount/currency.")
+            return
 
-    session = db_session()
-    try:
         match = session.query(Match).filter_by(id=match_id).first()
         if not match:
-            await update.effective_message.reply_text("Match not found.")
+            await reject("match not found", "Match not found.")
             return
 
-        if uid != update.effective_user.id:
-            await update.effective_message.reply_text("Payment user mismatch.")
+        if uid != payer:
+            await reject("user mismatch", "Payment user mismatch.")
             return
 
         other_id = other_user_in_match(match, uid)
         if not other_id:
-            await update.effective_message.reply_text("You are not in this match.")
-            return
-
-        if is_unlocked_for_user(match, uid):
-            await update.effective_message.reply_text("Already unlocked.")
+            await reject("not in match", "You are not in this match.")
             return
 
         other = session.query(User).filter_by(telegram_id=other_id).first()
         if not other or not other.username:
-            await update.effective_message.reply_text("Other user's username not available.")
+            await reject("no username", "Other user's username not available.")
             return
 
-        set_unlocked_for_user(match, uid)
+        if not unlock_match_for_user(session, match_id, match, uid):
+            await reject("already unlocked", "Already unlocked.")
+            return
+        settle_payment(session, payment_id, "Applied")
         session.commit()
+        log_event("unlock", uid, other_id, m=match_id, via="paid")
 
         await update.effective_message.reply_text(
             f"✅ Payment success! Username unlocked:\n@{other.username}\nChat: https://t.me/{other.username}",
@@ -1179,7 +2804,57 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
     finally:
         session.close()
 
+async def cmd_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    session = db_session()
+    try:
+        rows = (
+            session.query(Payment)
+            .filter_by(telegram_id=update.effective_user.id)
+            .order_by(Payment.created_at.desc())
+            .limit(PAYMENT_HISTORY_SIZE)
+            .all()
+        )
+    finally:
+        session.close()
+
+    if not rows:
+        await update.effective_message.reply_text("No payments yet.")
+        return
+    lines = ["Your payments:"]
+    for p in rows:
+        lines.append(f"{p.created_at:%Y-%m-%d} — {p.total_amount} {p.currency} — {p.status} (#{p.id})")
+    await update.effective_message.reply_text("\n".join(lines))
+
 # ----------------- REFERRAL MENU -----------------
+REFERRAL_LEADERBOARD_SIZE = 10
+
+def referral_leaderboard_text(user: User) -> str:
+    # both queries walk ix_users_referral_count instead of scanning users
+    session = db_session()
+    try:
+        top = (
+            session.query(User.telegram_id, User.name, User.referral_count)
+            .filter(User.referral_count > 0)
+            .order_by(User.referral_count.desc())
+            .limit(REFERRAL_LEADERBOARD_SIZE)
+            .all()
+        )
+        rank = None
+        if user.referral_count:
+            rank = session.query(func.count(User.id)).filter(User.referral_count > user.referral_count).scalar() + 1
+    finally:
+        session.close()
+
+    if not top:
+        return "🏆 Leaderboard: no referrals yet, be the first!"
+    lines = ["🏆 Top referrers:"]
+    for i, (tid, name, count) in enumerate(top, 1):
+        me = " (you)" if tid == user.telegram_id else ""
+        lines.append(f"{i}. {(name or 'User').split()[0]} — {count}{me}")
+    if rank:
+        lines.append(f"\nYour rank: #{rank}")
+    return "\n".join(lines)
+
 async def menu_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = get_user(update.effective_user.id)
     if not user or not user.is_registered:
@@ -1191,12 +2866,29 @@ async def menu_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "✅ 3 successful referrals => 1 free username unlock\n\n"
         f"Your link:\n{referral_link(user)}\n\n"
         f"Successful referrals: {user.referral_count}\n"
-        f"Free unlocks available: {user.free_unlocks}",
+        f"Free unlocks available: {user.free_unlocks}\n\n"
+        f"{referral_leaderboard_text(user)}",
         disable_web_page_preview=True,
         reply_markup=main_menu_kb()
     )
 
 # ----------------- DELETE PROFILE (/delete) -----------------
+def purge_user_rows(session, uid: int):
+    session.query(BlockedProfile).filter(or_(BlockedProfile.blocker_id == uid, BlockedProfile.blocked_id == uid)).delete(synchronize_session=False)
+    session.query(MatchRequest).filter(or_(MatchRequest.requester_id == uid, MatchRequest.target_id == uid)).delete(synchronize_session=False)
+    session.query(Match).filter(or_(Match.user1_id == uid, Match.user2_id == uid)).delete(synchronize_session=False)
+    reported_ids = [r[0] for r in session.query(Report.reported_id).filter_by(reporter_id=uid).distinct() if r[0] != uid]
+    session.query(Report).filter(or_(Report.reporter_id == uid, Report.reported_id == uid)).delete(synchronize_session=False)
+    unhidden = recount_report_stats(session, reported_ids)
+    session.query(User).filter_by(telegram_id=uid).delete(synchronize_session=False)
+    session.execute(UsersArchive.delete().where(UsersArchive.c.telegram_id == uid))
+    session.query(ReportStat).filter_by(reported_id=uid).delete(synchronize_session=False)
+    session.query(SeenFilter).filter_by(telegram_id=uid).delete(synchronize_session=False)
+    hidden_user_ids.difference_update(unhidden + [uid])
+    match_member_cache.clear()  # rare; cheaper than tracking which matches were removed
+    seen_cache.pop(uid, None)
+    seen_dirty.discard(uid)
+
 async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Yes, delete my profile", callback_data="del:yes")],
@@ -1217,26 +2909,46 @@ async def cb_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     uid = q.from_user.id
+    reset_find_session(context)
     session = db_session()
     try:
         # remove relations
-        session.query(BlockedProfile).filter(or_(BlockedProfile.blocker_id == uid, BlockedProfile.blocked_id == uid)).delete(synchronize_session=False)
-        session.query(MatchRequest).filter(or_(MatchRequest.requester_id == uid, MatchRequest.target_id == uid)).delete(synchronize_session=False)
-        session.query(Match).filter(or_(Match.user1_id == uid, Match.user2_id == uid)).delete(synchronize_session=False)
-        session.query(Report).filter(or_(Report.reporter_id == uid, Report.reported_id == uid)).delete(synchronize_session=False)
-        session.query(User).filter_by(telegram_id=uid).delete(synchronize_session=False)
+        purge_user_rows(session, uid)
         session.commit()
     finally:
         session.close()
 
+    if CANDIDATE_INDEX is not None:
+        CANDIDATE_INDEX.remove(uid)
+    invalidate_candidate_queues(uid)
+    mark_candidate_queues_stale()
+
     await q.message.reply_text("✅ Profile deleted successfully. /start anytime.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 # ----------------- BACK TO MAIN -----------------
+def has_unlock_buttons(message: Message) -> bool:
+    kb = message.reply_markup
+    return bool(kb) and any((b.callback_data or "").startswith("m:") for row in kb.inline_keyboard for b in row)
+
 async def cb_back_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    await q.message.reply_text("Main Menu:", reply_markup=main_menu_kb())
+    if has_unlock_buttons(q.message):
+        return  # "Later" on match notifications sent before m:later existed
+
+    # menus and the browse card are rewritten in place; other photos (View Profile) are kept
+    is_card = q.message.message_id == context.user_data.get("fm_card_msg_id")
+    if is_card or not q.message.photo:
+        if is_card:
+            context.user_data.pop("fm_card_msg_id", None)
+        await edit_or_reply(q.message, "Main Menu:", fallback_markup=main_menu_kb())
+    else:
+        await q.message.reply_text("Main Menu:", reply_markup=main_menu_kb())
+
+async def cb_match_later(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # leaves the notification and its unlock buttons in place
+    await update.callback_query.answer()
 
 # ----------------- ADMIN PANEL -----------------
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1247,7 +2959,8 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [
             ["Statics", "Broadcast"],
             ["Reports", "View user"],
-            ["Delete user"],
+            ["Delete user", "Triage"],
+            ["Regions"],
         ],
         resize_keyboard=True
     )
@@ -1264,25 +2977,161 @@ async def admin_statics(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pending_reports = session.query(Report).filter_by(status="Pending").count()
         matches = session.query(Match).count()
         pending_requests = session.query(MatchRequest).filter_by(status="Pending").count()
+        archived = session.query(UsersArchive).count()
     finally:
         session.close()
 
+    backup = context.bot_data.get("last_backup", "never")
+    compaction = "never"
+    last = context.bot_data.get("last_compaction")
+    if last:
+        compaction = f"{last['at']:%Y-%m-%d %H:%M} UTC, {last['expired']} expired, {last['deleted']} deleted"
+
     await update.effective_message.reply_text(
         f"Statics:\n"
         f"Total users: {total}\n"
         f"Registered users: {registered}\n"
+        f"Archived users: {archived}\n"
         f"Pending requests: {pending_requests}\n"
         f"Matches: {matches}\n"
-        f"Pending reports: {pending_reports}"
+        f"Pending reports: {pending_reports}\n"
+        f"Last request compaction: {compaction}\n"
+        f"Last backup: {backup}\n\n"
+        f"{OUTBOUND_LIMITER.stats_text()}"
     )
 
 # --- Admin Broadcast (copy any message type) ---
+# A segment is a dict of filters parsed from "key=value; key=value". It compiles to an
+# ID-only SELECT on indexed columns, so neither the preview count nor the send loads
+# User rows.
+SEGMENT_COUNT_TTL = 300  # seconds a previewed segment size is reused
+SEGMENT_HELP = (
+    "Send filters as key=value separated by ';', e.g.\n"
+    "country=India; city=Delhi; age=18-25; active=7\n\n"
+    "gender=Male|Female|Other\n"
+    "country=<name>, city=<name> (case-insensitive)\n"
+    "age=<n> or <min>-<max>\n"
+    "joined=<days>: registered in the last N days\n"
+    "active=<days>: used the bot in the last N days\n"
+    "match=yes|no: has at least one match"
+)
+
+segment_count_cache: Dict[str, Tuple[float, int]] = {}  # segment_label -> (counted_at, size)
+
+def parse_segment(text: str) -> Tuple[dict, Optional[str]]:
+    """Returns (segment, error). The keyboard presets are shorthands for gender filters."""
+    text = (text or "").strip()
+    if text == "All":
+        return {}, None
+    if text in ("Male", "Female", "Other"):
+        return {"gender": text}, None
+
+    segment = {}
+    for part in text.replace("\n", ";").split(";"):
+        if not part.strip():
+            continue
+        key, sep, value = part.partition("=")
+        key, value = key.strip().lower(), value.strip()
+        if not sep or not value:
+            return {}, f"Can't read '{part.strip()}', expected key=value."
+        try:
+            if key == "gender":
+                if value.capitalize() not in ("Male", "Female", "Other"):
+                    return {}, "gender must be Male, Female or Other."
+                segment[key] = value.capitalize()
+            elif key in ("country", "city"):
+                segment[key] = value
+            elif key == "age":
+                lo, _, hi = value.partition("-")
+                segment[key] = (int(lo), int(hi or lo))
+            elif key in ("joined", "active"):
+                segment[key] = int(value)
+            elif key == "match":
+                if value.lower() not in ("yes", "no"):
+                    return {}, "match must be yes or no."
+                segment[key] = value.lower() == "yes"
+            else:
+                return {}, f"Unknown filter '{key}'."
+        except ValueError:
+            return {}, f"'{value}' is not a number."
+    if not segment:
+        return {}, "Empty segment."
+    return segment, None
+
+def segment_label(segment: dict) -> str:
+    if not segment:
+        return "All registered users"
+    parts = []
+    for key in sorted(segment):
+        value = segment[key]
+        if key == "age":
+            value = f"{value[0]}-{value[1]}"
+        elif key == "match":
+            value = "yes" if value else "no"
+        parts.append(f"{key}={value}")
+    return "; ".join(parts)
+
+def segment_select(segment: dict):
+    stmt = select(User.telegram_id).where(User.is_registered == True)
+    now = datetime.datetime.utcnow()
+    if "gender" in segment:
+        stmt = stmt.where(User.gender == segment["gender"])
+    if "country" in segment:
+        stmt = stmt.where(User.country.collate("NOCASE") == segment["country"])
+    if "city" in segment:
+        stmt = stmt.where(User.city.collate("NOCASE") == segment["city"])
+    if "age" in segment:
+        stmt = stmt.where(User.age.between(*segment["age"]))
+    if "joined" in segment:
+        stmt = stmt.where(User.created_at >= now - datetime.timedelta(days=segment["joined"]))
+    if "active" in segment:
+        stmt = stmt.where(User.last_active_at >= now - datetime.timedelta(days=segment["active"]))
+    if "match" in segment:
+        has_match = select(Match.id).where(
+            or_(Match.user1_id == User.telegram_id, Match.user2_id == User.telegram_id)
+        ).exists()
+        stmt = stmt.where(has_match if segment["match"] else ~has_match)
+    return stmt
+
+def segment_size(segment: dict) -> Tuple[int, int]:
+    """(size, seconds since it was counted); counts are cached for SEGMENT_COUNT_TTL."""
+    key = segment_label(segment)
+    now = time.monotonic()
+    cached = segment_count_cache.get(key)
+    if cached and now - cached[0] < SEGMENT_COUNT_TTL:
+        return cached[1], int(now - cached[0])
+
+    session = db_session()
+    try:
+        size = session.execute(select(func.count()).select_from(segment_select(segment).subquery())).scalar()
+    finally:
+        session.close()
+    segment_count_cache[key] = (now, size)
+    return size, 0
+
+def segment_id_pages(segment: dict, page: int = 1000):
+    """Target ids a page at a time (keyset on telegram_id); no cursor stays open while sending."""
+    last = None
+    while True:
+        stmt = segment_select(segment)
+        if last is not None:
+            stmt = stmt.where(User.telegram_id > last)
+        session = db_session()
+        try:
+            ids = session.execute(stmt.order_by(User.telegram_id).limit(page)).scalars().all()
+        finally:
+            session.close()
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
 async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not is_admin(update.effective_user.id):
         return ConversationHandler.END
 
     kb = ReplyKeyboardMarkup(
-        [["All", "Male", "Female"], ["Other", "Cancel"]],
+        [["All", "Male", "Female"], ["Other", "Custom", "Cancel"]],
         resize_keyboard=True, one_time_keyboard=True
     )
     await update.effective_message.reply_text("Broadcast audience choose करो:", reply_markup=kb)
@@ -1297,12 +3146,27 @@ async def admin_broadcast_audience(update: Update, context: ContextTypes.DEFAULT
         await update.effective_message.reply_text("Broadcast canceled.", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
-    if aud not in ["All", "Male", "Female", "Other"]:
-        await update.effective_message.reply_text("Select a valid option All/Male/Female/Other or Cancel")
+    if aud == "Custom":
+        await update.effective_message.reply_text(SEGMENT_HELP, reply_markup=ReplyKeyboardRemove())
+        return ST_ADMIN_BC_AUDIENCE
+
+    segment, error = parse_segment(aud)
+    if error:
+        await update.effective_message.reply_text(
+            f"{error}\nSelect All/Male/Female/Other, send a Custom segment, or Cancel"
+        )
+        return ST_ADMIN_BC_AUDIENCE
+
+    flush_activity()
+    size, age = segment_size(segment)
+    if not size:
+        await update.effective_message.reply_text("No users match this segment. Try another one or Cancel.")
         return ST_ADMIN_BC_AUDIENCE
 
-    context.user_data["bc_aud"] = aud
+    context.user_data["bc_segment"] = segment
     await update.effective_message.reply_text(
+        f"Segment: {segment_label(segment)}\n"
+        f"Users: {size}" + (f" (counted {age}s ago)" if age else "") + "\n\n"
         "Now whatever message you send (text/photo/video/audio/document) will be broadcast.",
         reply_markup=ReplyKeyboardRemove()
     )
@@ -1312,78 +3176,519 @@ async def admin_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYP
     if not is_admin(update.effective_user.id):
         return ConversationHandler.END
 
-    aud = context.user_data.get("bc_aud", "All")
+    segment = context.user_data.get("bc_segment", {})
     src_chat_id = update.effective_chat.id
     src_msg_id = update.effective_message.message_id
 
+    size, _ = segment_size(segment)
+
+    # runs as a background task at broadcast priority, so other updates keep being handled
+    context.application.create_task(run_broadcast(context, src_chat_id, src_msg_id, segment))
+    await update.effective_message.reply_text(f"Broadcast started to ~{size} users.")
+    return ConversationHandler.END
+
+async def run_broadcast(context: ContextTypes.DEFAULT_TYPE, src_chat_id: int, src_msg_id: int, segment: dict):
+    sent = 0
+    failed = 0
+    for page in segment_id_pages(segment):
+        for tid in page:
+            try:
+                await context.bot.copy_message(
+                    chat_id=tid, from_chat_id=src_chat_id, message_id=src_msg_id, rate_limit_args=PRIORITY_BROADCAST
+                )
+                sent += 1
+            except Exception:
+                failed += 1
+
+    await context.bot.send_message(chat_id=src_chat_id, text=f"Broadcast done.\nSent: {sent}\nFailed: {failed}")
+
+# --- Admin Reports ---
+REPORTS_PAGE_SIZE = 10
+REPORT_DIGEST_INTERVAL = 15 * 60  # seconds between admin report digests
+
+async def job_report_digest(context: ContextTypes.DEFAULT_TYPE):
+    """Coalesces reports filed since the last digest into one admin message."""
+    if not ADMIN_TELEGRAM_ID:
+        return
     session = db_session()
     try:
-        q = session.query(User).filter(User.is_registered == True)
-        if aud in ["Male", "Female", "Other"]:
-            q = q.filter(User.gender == aud)
-        targets = [u.telegram_id for u in q.all()]
+        watermark = session.query(func.max(ReportDigest.last_report_id)).scalar() or 0
+        new = session.query(func.count(Report.id), func.max(Report.id)).filter(Report.id > watermark).one()
+        count, last_id = new
+        if not count:
+            return
+
+        top_reported = session.query(Report.reported_id, func.count(Report.id).label("n")).filter(
+            Report.id > watermark
+        ).group_by(Report.reported_id).order_by(func.count(Report.id).desc()).limit(10).all()
+
+        reasons: Dict[str, int] = {}
+        for reason, n in session.query(Report.reason, func.count(Report.id)).filter(
+            Report.id > watermark
+        ).group_by(Report.reason).all():
+            base = reason.split(":", 1)[0]  # fold "Other: free text" together
+            reasons[base] = reasons.get(base, 0) + n
+        top_reasons = sorted(reasons.items(), key=lambda x: x[1], reverse=True)[:5]
+
+        text = f"🚩 Report digest: {count} new report{'s' if count != 1 else ''}\n\nMost reported:\n"
+        text += "".join(f"• {rid} — {n}\n" for rid, n in top_reported)
+        text += "\nTop reasons:\n" + "".join(f"• {r} — {n}\n" for r, n in top_reasons)
+        text += "\nAdmin Panel -> Reports to review."
+
+        session.add(ReportDigest(last_report_id=last_id, report_count=count))
+        enqueue_notification(session, ADMIN_TELEGRAM_ID, text, dedup_key=f"digest:{last_id}")
+        session.commit()
     finally:
         session.close()
+    kick_outbox(context)
 
-    sent = 0
-    failed = 0
-    for tid in targets:
-        try:
-            await context.bot.copy_message(chat_id=tid, from_chat_id=src_chat_id, message_id=src_msg_id)
-            sent += 1
-        except Exception:
-            failed += 1
+def render_reports_page(offset: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    session = db_session()
+    try:
+        base = session.query(Report).filter_by(status="Pending")
+        total = base.count()
+        if not total:
+            return "No pending reports.", None
+        offset = max(0, min(offset, (total - 1) // REPORTS_PAGE_SIZE * REPORTS_PAGE_SIZE))
+        reps = base.order_by(Report.created_at.desc()).offset(offset).limit(REPORTS_PAGE_SIZE).all()
+    finally:
+        session.close()
 
-    await update.effective_message.reply_text(f"Broadcast done.\nSent: {sent}\nFailed: {failed}")
-    return ConversationHandler.END
+    lines = [f"Pending reports {offset + 1}-{offset + len(reps)} of {total}\n"]
+    for r in reps:
+        lines.append(f"#{r.id} | Reported: {r.reported_id} | Reporter: {r.reporter_id}\n{r.reason} ({r.created_at:%Y-%m-%d %H:%M})")
+
+    buttons = [InlineKeyboardButton(f"✅ #{r.id}", callback_data=f"admin:rep_review:{r.id}:{offset}") for r in reps]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:rep_page:{max(0, offset - REPORTS_PAGE_SIZE)}"))
+    if offset + REPORTS_PAGE_SIZE < total:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin:rep_page:{offset + REPORTS_PAGE_SIZE}"))
+    if nav:
+        rows.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
 
-# --- Admin Reports ---
 async def admin_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
 
+    text, kb = render_reports_page(0)
+    await update.effective_message.reply_text(text, reply_markup=kb)
+
+async def cb_admin_report_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    if not is_admin(q.from_user.id):
+        return
+
+    text, kb = render_reports_page(context.args[0])
+    await edit_or_reply(q.message, text, kb)
+
+async def cb_admin_report_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(q.from_user.id):
+        await q.answer()
+        return
+
+    rid, offset = (context.args + [0])[:2]
     session = db_session()
     try:
-        reps = session.query(Report).filter_by(status="Pending").order_by(Report.created_at.desc()).limit(20).all()
-        if not reps:
-            await update.effective_message.reply_text("No pending reports.")
-            return
+        updated = session.query(Report).filter_by(id=rid).update({Report.status: "Reviewed"}, synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
 
-        for r in reps:
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Mark Reviewed", callback_data=f"admin:rep_review:{r.id}")]
-            ])
-            await update.effective_message.reply_text(
-                f"Report ID: {r.id}\nReporter: {r.reporter_id}\nReported: {r.reported_id}\nReason: {r.reason}\nTime: {r.created_at}",
-                reply_markup=kb
-            )
+    await q.answer(f"✅ Report {rid} marked reviewed." if updated else "Report not found.")
+    text, kb = render_reports_page(offset)
+    await edit_or_reply(q.message, text, kb)
+
+# --- Admin Report Triage ---
+TRIAGE_PAGE_SIZE = 10
+
+def render_triage_page(offset: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    session = db_session()
+    try:
+        total = session.query(func.count(ReportStat.reported_id)).scalar()
+        if not total:
+            return "No reported users.", None
+        offset = max(0, min(offset, (total - 1) // TRIAGE_PAGE_SIZE * TRIAGE_PAGE_SIZE))
+        stats = session.query(ReportStat).order_by(
+            ReportStat.distinct_reporters.desc(), ReportStat.total_reports.desc()
+        ).offset(offset).limit(TRIAGE_PAGE_SIZE).all()
     finally:
         session.close()
 
-async def cb_admin_report_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    lines = [f"Report triage {offset + 1}-{offset + len(stats)} of {total} (hide at {REPORT_HIDE_THRESHOLD} reporters)\n"]
+    rows = []
+    for st in stats:
+        flag = "🙈 " if st.hidden else ""
+        last = f"{st.last_report_at:%Y-%m-%d %H:%M}" if st.last_report_at else "N/A"
+        lines.append(f"{flag}{st.reported_id}: {st.distinct_reporters} reporters, {st.total_reports} reports, last {last}")
+        action = "unhide" if st.hidden else "hide"
+        rows.append([InlineKeyboardButton(
+            f"{'Unhide' if st.hidden else 'Hide'} {st.reported_id}",
+            callback_data=f"admin:triage_{action}:{st.reported_id}:{offset}"
+        )])
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:triage_page:{max(0, offset - TRIAGE_PAGE_SIZE)}"))
+    if offset + TRIAGE_PAGE_SIZE < total:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin:triage_page:{offset + TRIAGE_PAGE_SIZE}"))
+    if nav:
+        rows.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
+
+async def admin_triage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    text, kb = render_triage_page(0)
+    await update.effective_message.reply_text(text, reply_markup=kb)
+
+async def cb_admin_triage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     if not is_admin(q.from_user.id):
         return
 
-    rid = int(q.data.split(":")[2])
+    if q.data.startswith("admin:triage_page:"):
+        offset = context.args[0]
+    else:
+        tid, offset = (context.args + [0])[:2]
+        hidden = q.data.startswith("admin:triage_hide:")
+        session = db_session()
+        try:
+            session.query(ReportStat).filter_by(reported_id=tid).update({ReportStat.hidden: hidden}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+        set_user_hidden(tid, hidden)
+
+    text, kb = render_triage_page(offset)
+    await edit_or_reply(q.message, text, kb)
+
+# --- Admin Regions ---
+# Rollups are fed incrementally: each source is read past its id watermark and the
+# counts + new watermark are committed together, so every row is counted once.
+ROLLUP_INTERVAL = 3600
+ROLLUP_BATCH = 2000
+SIGNUP_SETTLE = datetime.timedelta(minutes=5)  # registered_at is stamped before commit; let late commits land
+REGIONS_TOP = 10
+REGIONS_RECENT_DAYS = 7
+
+def regions_of(session, telegram_ids) -> Dict[int, Tuple[str, str]]:
+    rows = session.query(User.telegram_id, User.country, User.city).filter(User.telegram_id.in_(set(telegram_ids))).all()
+    return {tid: (country or "", city or "") for tid, country, city in rows}
+
+def collect_signups(session, wm: RollupWatermark) -> Tuple[List[tuple], list]:
+    # keyed by registered_at, not users.id: a profile completed days after /start still counts,
+    # and a restored archive row (new id, same registered_at) is not counted again
+    settled = datetime.datetime.utcnow() - SIGNUP_SETTLE
+    q = session.query(User.id, User.registered_at, User.country, User.city).filter(
+        User.registered_at.isnot(None), User.registered_at < settled
+    )
+    if wm.last_at is not None:
+        q = q.filter(or_(
+            User.registered_at > wm.last_at,
+            and_(User.registered_at == wm.last_at, User.id > (wm.last_id or 0)),
+        ))
+    rows = q.order_by(User.registered_at, User.id).limit(ROLLUP_BATCH).all()
+    events = [(f"{r.registered_at:%Y-%m-%d}", r.country or "", r.city or "") for r in rows]
+    return events, rows
+
+def collect_matches(session, wm: RollupWatermark) -> Tuple[List[tuple], list]:
+    last_id = wm.last_id or 0
+    rows = session.query(Match.id, Match.created_at, Match.user1_id, Match.user2_id).filter(
+        Match.id > last_id
+    ).order_by(Match.id).limit(ROLLUP_BATCH).all()
+    if not rows:
+        return [], rows
+    regions = regions_of(session, [r.user1_id for r in rows] + [r.user2_id for r in rows])
+    events = []
+    for r in rows:
+        # a match counts once for each member's region (once if they share it)
+        for region in {regions.get(r.user1_id, ("", "")), regions.get(r.user2_id, ("", ""))}:
+            events.append((f"{r.created_at:%Y-%m-%d}",) + region)
+    return events, rows
+
+def collect_reports(session, wm: RollupWatermark) -> Tuple[List[tuple], list]:
+    last_id = wm.last_id or 0
+    rows = session.query(Report.id, Report.created_at, Report.reported_id).filter(
+        Report.id > last_id
+    ).order_by(Report.id).limit(ROLLUP_BATCH).all()
+    if not rows:
+        return [], rows
+    regions = regions_of(session, [r.reported_id for r in rows])
+    events = [(f"{r.created_at:%Y-%m-%d}",) + regions.get(r.reported_id, ("", "")) for r in rows]
+    return events, rows
+
+ROLLUP_SOURCES = {"signups": collect_signups, "matches": collect_matches, "reports": collect_reports}
+
+def add_region_counts(session, field: str, events: List[tuple]):
+    """events are (day, country, city); bumps region_daily and region_totals in place."""
+    daily = Counter(events)
+    totals = Counter((country, city) for _, country, city in events)
+    for model, counts, keys in (
+        (RegionDaily, daily, ("day", "country", "city")),
+        (RegionTotal, totals, ("country", "city")),
+    ):
+        stmt = sqlite_insert(model)
+        session.execute(
+            stmt.on_conflict_do_update(
+                index_elements=list(keys),
+                set_={field: getattr(model, field) + stmt.excluded[field]}
+            ),
+            [dict(zip(keys, key), **{field: n}) for key, n in counts.items()]
+        )
+
+def rollup_batch(source: str) -> int:
+    """Counts one batch of a source; returns how many source rows were consumed."""
     session = db_session()
     try:
-        r = session.query(Report).filter_by(id=rid).first()
-        if r:
-            r.status = "Reviewed"
-            session.commit()
-            await q.message.reply_text(f"✅ Report {rid} marked reviewed.")
+        wm = session.query(RollupWatermark).filter_by(source=source).first()
+        if not wm:
+            wm = RollupWatermark(source=source, last_id=0)
+            session.add(wm)
+        events, rows = ROLLUP_SOURCES[source](session, wm)
+        if not rows:
+            return 0
+        if events:
+            add_region_counts(session, source, events)
+        wm.last_id = rows[-1].id
+        wm.last_at = getattr(rows[-1], "registered_at", None)
+        session.commit()
+        return len(rows)
     finally:
         session.close()
 
+def snapshot_registered():
+    session = db_session()
+    try:
+        rows = session.query(
+            func.coalesce(User.country, ""), func.coalesce(User.city, ""), func.count(User.id)
+        ).filter(User.is_registered == True).group_by(User.country, User.city).all()
+        session.query(RegionTotal).update({RegionTotal.registered: 0}, synchronize_session=False)
+        if rows:
+            stmt = sqlite_insert(RegionTotal)
+            session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["country", "city"], set_={"registered": stmt.excluded.registered}
+                ),
+                [{"country": c, "city": ci, "registered": n} for c, ci, n in rows]
+            )
+        session.commit()
+    finally:
+        session.close()
+
+async def job_region_rollups(context: ContextTypes.DEFAULT_TYPE):
+    for source in ROLLUP_SOURCES:
+        while rollup_batch(source) >= ROLLUP_BATCH:
+            await asyncio.sleep(0)
+    snapshot_registered()
+
+def region_key(country: str) -> str:
+    """Short fixed-size callback key; a raw name can pass Telegram's 64-byte callback_data limit."""
+    return hashlib.blake2b((country or "").encode(), digest_size=6).hexdigest()
+
+def country_by_key(key: str) -> Optional[str]:
+    session = db_session()
+    try:
+        countries = [r[0] for r in session.query(RegionTotal.country).distinct()]
+    finally:
+        session.close()
+    return next((c for c in countries if region_key(c) == key), None)
+
+def render_regions(country: Optional[str] = None) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    since = f"{datetime.datetime.utcnow() - datetime.timedelta(days=REGIONS_RECENT_DAYS):%Y-%m-%d}"
+    session = db_session()
+    try:
+        # country level sums a handful of rows per country; city level reads one country's rows
+        key = RegionTotal.city if country is not None else RegionTotal.country
+        q = session.query(
+            key, func.sum(RegionTotal.registered), func.sum(RegionTotal.signups),
+            func.sum(RegionTotal.matches), func.sum(RegionTotal.reports),
+        )
+        if country is not None:
+            q = q.filter(RegionTotal.country == country)
+        top = q.group_by(key).order_by(func.sum(RegionTotal.registered).desc()).limit(REGIONS_TOP).all()
+
+        dkey = RegionDaily.city if country is not None else RegionDaily.country
+        rq = session.query(dkey, func.sum(RegionDaily.signups)).filter(RegionDaily.day >= since)
+        if country is not None:
+            rq = rq.filter(RegionDaily.country == country)
+        recent = dict(rq.group_by(dkey).all())
+    finally:
+        session.close()
+
+    if not top:
+        return "No regional data yet (rollups run hourly).", None
+
+    title = f"Top cities in {country or 'Unknown'}" if country is not None else "Top countries"
+    lines = [f"{title} (new = last {REGIONS_RECENT_DAYS}d signups):\n"]
+    buttons = []
+    for name, registered, signups, matches, reports in top:
+        rate = f"{100 * matches / registered:.0f}" if registered else "-"
+        lines.append(
+            f"{name or 'Unknown'}: {registered} users, +{recent.get(name, 0) or 0} new, "
+            f"{matches} matches ({rate}/100 users), {reports} reports"
+        )
+        if country is None:
+            buttons.append([InlineKeyboardButton(f"Cities: {name or 'Unknown'}", callback_data=f"admin:region:{region_key(name)}")])
+    if country is not None:
+        buttons.append([InlineKeyboardButton("⬅️ Countries", callback_data="admin:regions")])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+async def admin_regions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    text_, kb = render_regions()
+    await update.effective_message.reply_text(text_, reply_markup=kb)
+
+async def cb_admin_regions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    if not is_admin(q.from_user.id):
+        return
+
+    country = None
+    if context.args:
+        country = country_by_key(context.args[0])
+        if country is None:
+            await q.message.reply_text("Region not found. Open Regions again.")
+            return
+    text_, kb = render_regions(country)
+    await edit_or_reply(q.message, text_, kb)
+
+# --- Admin User Search ---
+SEARCH_PAGE_SIZE = 8
+FUZZY_TERMS_PER_TOKEN = 3
+
+def find_user_exact(session, ident: str, bare_username: bool = True) -> Optional[User]:
+    """Numeric Telegram ID or @username (any case); None means "search instead".
+    With bare_username=False a word without "@" is never taken as a username (Delete)."""
+    ident = ident.strip()
+    if not bare_username and not ident.startswith("@") and not ident.isdigit():
+        return None
+    ident = ident.lstrip("@")
+    if ident.isdigit():
+        return session.query(User).filter_by(telegram_id=int(ident)).first()
+    return session.query(User).filter(func.lower(User.username) == ident.lower()).first()
+
+def search_tokens(query: str) -> List[str]:
+    # same split as the unicode61 tokenizer, so "john_doe" searches "john" and "doe"
+    return re.findall(r"[^\W_]+", query.lower())[:6]
+
+def fuzzy_terms(conn, token: str) -> List[str]:
+    """Close spellings of token from the FTS vocabulary, scanning only terms with its first letter."""
+    terms = [r[0] for r in conn.execute(
+        text("SELECT term FROM users_fts_vocab WHERE term >= :lo AND term < :hi"),
+        {"lo": token[0], "hi": chr(ord(token[0]) + 1)}
+    )]
+    return difflib.get_close_matches(token, terms, n=FUZZY_TERMS_PER_TOKEN, cutoff=0.7)
+
+def search_users(query: str, offset: int, limit: int = SEARCH_PAGE_SIZE) -> Tuple[List[tuple], bool, bool]:
+    """Returns (rows of (telegram_id, name, username, city, country), has_more, fuzzy)."""
+    tokens = search_tokens(query)
+    if not tokens:
+        return [], False, False
+
+    with engine.connect() as conn:
+        if not USER_SEARCH_FTS:
+            rows = conn.execute(
+                select(User.telegram_id, User.name, User.username, User.city, User.country)
+                .where(func.lower(User.username).startswith(tokens[0]))
+                .order_by(func.lower(User.username)).offset(offset).limit(limit + 1)
+            ).all()
+            return rows[:limit], len(rows) > limit, False
+
+        sql = text(
+            "SELECT u.telegram_id, u.name, u.username, u.city, u.country "
+            "FROM users_fts JOIN users u ON u.id = users_fts.rowid "
+            "WHERE users_fts MATCH :q ORDER BY rank LIMIT :limit OFFSET :offset"
+        )
+        match = " AND ".join(f'"{t}"*' for t in tokens)
+        rows = conn.execute(sql, {"q": match, "limit": limit + 1, "offset": offset}).all()
+        fuzzy = False
+        if not rows:
+            # nothing by prefix: retry with vocabulary terms a typo or two away
+            groups = []
+            for t in tokens:
+                alts = fuzzy_terms(conn, t) if len(t) >= 3 else []
+                groups.append("(" + " OR ".join(f'"{a}"' for a in [t] + alts) + ")")
+            fuzzy = True
+            rows = conn.execute(sql, {"q": " AND ".join(groups), "limit": limit + 1, "offset": offset}).all()
+    return rows[:limit], len(rows) > limit, fuzzy
+
+def render_search_page(query: str, offset: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    rows, has_more, fuzzy = search_users(query, offset)
+    if not rows:
+        return f"No users found for '{query}'.", None
+
+    head = f"Results {offset + 1}-{offset + len(rows)} for '{query}'"
+    lines = [head + (" (fuzzy)" if fuzzy else "") + ":\n"]
+    buttons = []
+    for tid, name, username, city, country in rows:
+        loc = ", ".join(x for x in (city, country) if x) or "N/A"
+        lines.append(f"{tid}: {name or 'N/A'} @{username or 'N/A'} — {loc}")
+        buttons.append([InlineKeyboardButton(f"View {name or tid}", callback_data=f"admin:view:{tid}")])
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin:search:{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin:search:{offset + SEARCH_PAGE_SIZE}"))
+    if nav:
+        buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+async def cb_admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    if not is_admin(q.from_user.id):
+        return
+
+    arg = context.args[0]
+    if q.data.startswith("admin:view:"):
+        u = get_user(arg)
+        if not u:
+            await q.message.reply_text("User not found.")
+            return
+        await send_admin_user_card(q.message, u)
+        return
+
+    query = context.user_data.get("admin_search")
+    if not query:
+        await q.message.reply_text("Search expired. Use View user again.")
+        return
+    text_, kb = render_search_page(query, arg)
+    await edit_or_reply(q.message, text_, kb)
+
 # --- Admin View User ---
 async def admin_view_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not is_admin(update.effective_user.id):
         return ConversationHandler.END
-    await update.effective_message.reply_text("Enter Telegram ID or @username:")
+    await update.effective_message.reply_text("Enter Telegram ID, @username, or a name/city to search:")
     return ST_ADMIN_VIEW_USER
 
+async def send_admin_user_card(message: Message, u: User):
+    cap = (
+        f"User Profile (Admin View)\n"
+        f"Name: {u.name}\n"
+        f"Telegram ID: {u.telegram_id}\n"
+        f"Username: @{u.username if u.username else 'N/A'}\n"
+        f"Age: {u.age}\nGender: {u.gender}\n"
+        f"Location: {u.city}, {u.country}\n"
+        f"Registered: {u.is_registered}\n"
+        f"Referred by: {u.referred_by_id}\n"
+        f"Referral count: {u.referral_count}\n"
+        f"Free unlocks: {u.free_unlocks}\n"
+    )
+    if u.profile_picture_file_id:
+        await message.reply_photo(photo=u.profile_picture_file_id, caption=cap)
+    else:
+        await message.reply_text(cap)
+
 async def admin_view_user_do(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not is_admin(update.effective_user.id):
         return ConversationHandler.END
@@ -1391,45 +3696,23 @@ async def admin_view_user_do(update: Update, context: ContextTypes.DEFAULT_TYPE)
     ident = (update.effective_message.text or "").strip()
     session = db_session()
     try:
-        u = None
-        if ident.startswith("@"):
-            ident = ident[1:]
-        try:
-            tid = int(ident)
-            u = session.query(User).filter_by(telegram_id=tid).first()
-        except Exception:
-            u = session.query(User).filter_by(username=ident).first()
-
-        if not u:
-            await update.effective_message.reply_text("User not found.")
+        u = find_user_exact(session, ident)
+        if u:
+            await send_admin_user_card(update.effective_message, u)
             return ConversationHandler.END
-
-        cap = (
-            f"User Profile (Admin View)\n"
-            f"Name: {u.name}\n"
-            f"Telegram ID: {u.telegram_id}\n"
-            f"Username: @{u.username if u.username else 'N/A'}\n"
-            f"Age: {u.age}\nGender: {u.gender}\n"
-            f"Location: {u.city}, {u.country}\n"
-            f"Registered: {u.is_registered}\n"
-            f"Referred by: {u.referred_by_id}\n"
-            f"Referral count: {u.referral_count}\n"
-            f"Free unlocks: {u.free_unlocks}\n"
-        )
-        if u.profile_picture_file_id:
-            await update.effective_message.reply_photo(photo=u.profile_picture_file_id, caption=cap)
-        else:
-            await update.effective_message.reply_text(cap)
     finally:
         session.close()
 
+    context.user_data["admin_search"] = ident
+    text_, kb = render_search_page(ident, 0)
+    await update.effective_message.reply_text(text_, reply_markup=kb)
     return ConversationHandler.END
 
 # --- Admin Delete User ---
 async def admin_delete_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not is_admin(update.effective_user.id):
         return ConversationHandler.END
-    await update.effective_message.reply_text("Enter Telegram ID or @username to delete:")
+    await update.effective_message.reply_text("Enter Telegram ID or @username to delete (or a name to search):")
     return ST_ADMIN_DELETE_USER
 
 async def admin_delete_user_do(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1437,29 +3720,25 @@ async def admin_delete_user_do(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
     ident = (update.effective_message.text or "").strip()
-    if ident.startswith("@"):
-        ident = ident[1:]
 
     session = db_session()
     try:
-        u = None
-        try:
-            tid = int(ident)
-            u = session.query(User).filter_by(telegram_id=tid).first()
-        except Exception:
-            u = session.query(User).filter_by(username=ident).first()
-
+        u = find_user_exact(session, ident, bare_username=False)
         if not u:
-            await update.effective_message.reply_text("User not found.")
+            # never delete from a fuzzy hit: list candidates and ask for the exact ID
+            text_, _ = render_search_page(ident, 0)
+            await update.effective_message.reply_text(
+                text_ + "\n\nNothing deleted. Use Delete user again with the exact Telegram ID."
+            )
             return ConversationHandler.END
 
         uid = u.telegram_id
-        session.query(BlockedProfile).filter(or_(BlockedProfile.blocker_id == uid, BlockedProfile.blocked_id == uid)).delete(synchronize_session=False)
-        session.query(MatchRequest).filter(or_(MatchRequest.requester_id == uid, MatchRequest.target_id == uid)).delete(synchronize_session=False)
-        session.query(Match).filter(or_(Match.user1_id == uid, Match.user2_id == uid)).delete(synchronize_session=False)
-        session.query(Report).filter(or_(Report.reporter_id == uid, Report.reported_id == uid)).delete(synchronize_session=False)
-        session.query(User).filter_by(telegram_id=uid).delete(synchronize_session=False)
+        purge_user_rows(session, uid)
         session.commit()
+        if CANDIDATE_INDEX is not None:
+            CANDIDATE_INDEX.remove(uid)
+        invalidate_candidate_queues(uid)
+        mark_candidate_queues_stale()
 
         await update.effective_message.reply_text(f"✅ Deleted user: {uid}")
     finally:
@@ -1475,13 +3754,418 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.effective_message.reply_text("Type /start")
 
+# ----------------- BACKUP -----------------
+# Online snapshots with SQLite's backup API: BACKUP_PAGES_PER_STEP pages per step and
+# the source lock is released between steps, so handlers keep writing. The copy runs
+# in a worker thread, is integrity-checked, and only then renamed into place.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = 7
+BACKUP_INTERVAL = 24 * 3600
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005  # seconds between steps
+
+def backup_database() -> Tuple[str, int]:
+    """Writes a verified snapshot and rotates old ones; returns (path, size in bytes)."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(BACKUP_DIR, f"trio_connect-{stamp}.db")
+    tmp = path + ".tmp"
+
+    src = sqlite3.connect(engine.url.database, timeout=30)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_PAUSE)
+        check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    if check != "ok":
+        os.remove(tmp)
+        raise RuntimeError(f"Backup failed integrity check: {check}")
+    os.replace(tmp, path)
+
+    snapshots = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("trio_connect-") and f.endswith(".db"))
+    for old in snapshots[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, old))
+    return path, os.path.getsize(path)
+
+async def run_backup(context: ContextTypes.DEFAULT_TYPE) -> str:
+    started = time.monotonic()
+    try:
+        path, size = await asyncio.to_thread(backup_database)
+    except Exception as e:
+        logger.exception("Backup failed")
+        context.bot_data["last_backup"] = f"FAILED at {datetime.datetime.utcnow():%Y-%m-%d %H:%M} UTC: {e}"
+        return context.bot_data["last_backup"]
+    took = time.monotonic() - started
+    context.bot_data["last_backup"] = (
+        f"{datetime.datetime.utcnow():%Y-%m-%d %H:%M} UTC, {size // 1024} KB in {took:.1f}s ({os.path.basename(path)})"
+    )
+    logger.info("Backup written to %s (%s bytes, %.1fs)", path, size, took)
+    return context.bot_data["last_backup"]
+
+async def job_backup(context: ContextTypes.DEFAULT_TYPE):
+    await run_backup(context)
+
+async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    await update.effective_message.reply_text("Backup started…")
+    await update.effective_message.reply_text(f"Backup: {await run_backup(context)}")
+
+# ----------------- EXPORT / IMPORT -----------------
+# Tables are streamed row by row into gzip'd JSONL or CSV, so memory stays flat
+# whatever the table size; imports go back in with batched executemany inserts.
+EXPORT_TABLES = ("users", "matches", "match_requests", "reports", "blocked_profiles")
+EXPORT_CHUNK = 1000
+
+def encode_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+def decode_value(column, value):
+    """Reverses encode_value/CSV stringification using the column type."""
+    if value is None or (value == "" and column.nullable):
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    if python_type is bool:
+        return value in (True, 1, "1", "True", "true")
+    if python_type in (int, float) and isinstance(value, str):
+        return python_type(value)
+    if python_type is bytes:
+        return bytes.fromhex(value)
+    return value
+
+def export_table(name: str, out_dir: str, fmt: str = "jsonl") -> Tuple[str, int]:
+    table = Base.metadata.tables[name]
+    path = os.path.join(out_dir, f"{name}.{fmt}.gz")
+    cols = [c.name for c in table.columns]
+    count = 0
+    with engine.connect() as conn, gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK).execute(select(table))
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(cols)
+        for row in result:
+            values = [encode_value(v) for v in row]
+            if writer:
+                writer.writerow(["" if v is None else v for v in values])
+            else:
+                f.write(json.dumps(dict(zip(cols, values)), ensure_ascii=False) + "\n")
+            count += 1
+    return path, count
+
+def export_all(out_dir: str, fmt: str = "jsonl") -> List[Tuple[str, int]]:
+    os.makedirs(out_dir, exist_ok=True)
+    return [export_table(name, out_dir, fmt) for name in EXPORT_TABLES]
+
+def read_export_file(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        if ".csv" in os.path.basename(path):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def import_file(path: str, table_name: Optional[str] = None) -> int:
+    """Loads one export file; rows whose unique keys already exist are skipped."""
+    table_name = table_name or os.path.basename(path).split(".", 1)[0]
+    if table_name not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table '{table_name}' for {path}")
+    table = Base.metadata.tables[table_name]
+    stmt = table.insert().prefix_with("OR IGNORE")
+    total = 0
+    batch = []
+
+    def flush() -> int:
+        with engine.begin() as conn:
+            return conn.execute(stmt, batch).rowcount
+
+    for record in read_export_file(path):
+        batch.append({c.name: decode_value(c, record.get(c.name)) for c in table.columns if c.name in record})
+        if len(batch) >= EXPORT_CHUNK:
+            total += flush()
+            batch = []
+    if batch:
+        total += flush()
+    return total
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    fmt = "csv" if context.args and context.args[0].lower() == "csv" else "jsonl"
+    await update.effective_message.reply_text(f"Exporting ({fmt})…")
+    with tempfile.TemporaryDirectory() as out_dir:
+        files = await asyncio.to_thread(export_all, out_dir, fmt)
+        for path, count in files:
+            with open(path, "rb") as f:
+                await update.effective_message.reply_document(
+                    document=f, filename=os.path.basename(path), caption=f"{count} rows"
+                )
+
+def run_cli(argv: List[str]) -> bool:
+    """Handles the maintenance subcommands; False means start the bot."""
+    if not argv or argv[0] not in ("export", "import", "events", "bench-routing"):
+        return False
+    parser = argparse.ArgumentParser(prog="trio-bot")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_exp = sub.add_parser("export", help="dump tables to gzip'd JSONL/CSV")
+    p_exp.add_argument("out_dir")
+    p_exp.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    p_imp = sub.add_parser("import", help="bulk load files written by export")
+    p_imp.add_argument("files", nargs="+")
+    p_imp.add_argument("--table", help="target table when it can't be read from the file name")
+    p_ev = sub.add_parser("events", help="count interaction events from the event log")
+    p_ev.add_argument("--since", type=datetime.datetime.fromisoformat, help="UTC date/time, e.g. 2024-05-01")
+    p_bench = sub.add_parser("bench-routing", help="compare handler lookup cost, regex chain vs route table")
+    p_bench.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    if args.cmd == "bench-routing":
+        print(f"{'update':<26}{'chain µs':>10}{'table µs':>10}{'speedup':>9}")
+        for name, chain, table in bench_routing(args.rounds):
+            print(f"{name:<26}{chain:>10.2f}{table:>10.2f}{chain / table:>8.1f}x")
+    elif args.cmd == "events":
+        for kind, n in sorted(event_funnel(args.since).items(), key=lambda kv: -kv[1]):
+            print(f"{kind}: {n}")
+    elif args.cmd == "export":
+        for path, count in export_all(args.out_dir, args.format):
+            print(f"{path}: {count} rows")
+    else:
+        for path in args.files:
+            print(f"{path}: {import_file(path, args.table)} rows imported")
+    return True
+
 # ----------------- MAIN -----------------
-def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def instrument_callback(callback):
+    if getattr(callback, "instrumented", False):
+        return callback
+
+    @functools.wraps(callback)
+    async def wrapped(update, context):
+        ctx = log_context.get()
+        if ctx is not None:
+            ctx["handler"] = callback.__name__
+        return await callback(update, context)
+
+    wrapped.instrumented = True
+    return wrapped
+
+def instrument_handler(handler):
+    """Wraps handler callbacks so log records know which handler ran (recurses into conversations)."""
+    if isinstance(handler, RouteTable):
+        handler.instrument(instrument_callback)
+        return
+    if isinstance(handler, ConversationHandler):
+        for h in handler.entry_points + handler.fallbacks:
+            instrument_handler(h)
+        for hs in handler.states.values():
+            for h in hs:
+                instrument_handler(h)
+        return
+    handler.callback = instrument_callback(handler.callback)
+
+class TrioApplication(Application):
+    """Sets the logging context for each update and logs how long it took."""
+
+    def add_handler(self, handler, group: int = 0) -> None:
+        instrument_handler(handler)
+        super().add_handler(handler, group)
+
+    async def process_update(self, update: object) -> None:
+        ctx = {}
+        if isinstance(update, Update):
+            ctx["update_id"] = update.update_id
+            if update.effective_user:
+                ctx["user_id"] = update.effective_user.id
+        token = log_context.set(ctx)
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            ms = round((time.perf_counter() - started) * 1000, 1)
+            update_logger.info("update handled", extra={"duration_ms": ms})
+            log_context.reset(token)
+
+async def on_shutdown(app: Application):
+    # write-behind buffers that would otherwise be lost
+    flush_seen_filters()
+    flush_activity()
+    write_events()
+
+# --- Routing ---
+# Menu texts and buttons that don't belong to a conversation are dispatched by one
+# handler with dict lookups instead of a chain of regex handlers. A callback's route
+# key is its first two ':' segments; the rest is parsed by the route's spec ("d" int,
+# "d?" optional int, "s" string) and handed to the callback as context.args.
+# Conversation-owned buttons (fm:, edit:, del:, start:create) stay with their
+# ConversationHandlers, which hold the per-user state.
+MENU_ROUTES = {
+    "View Your Profile": menu_view_profile,
+    "Requests": menu_requests,
+    "Refer 3 users to unlock 1 username": menu_referral,
+    "Statics": admin_statics,
+    "Reports": admin_reports,
+    "Triage": admin_triage,
+    "Regions": admin_regions,
+}
+CALLBACK_ROUTES = {
+    "start:help": (cb_start_menu, ""),
+    "start:privacy": (cb_start_menu, ""),
+    "start:back": (cb_start_menu, ""),
+    "back:main": (cb_back_main, ""),
+    "rq:accept": (cb_request_action, "d d?"),
+    "rq:reject": (cb_request_action, "d d?"),
+    "rq:page": (cb_request_page, "d"),
+    "m:free": (cb_match_unlock_free, "d"),
+    "m:pay": (cb_match_unlock_pay, "d"),
+    "m:later": (cb_match_later, ""),
+    "admin:rep_review": (cb_admin_report_review, "d d?"),
+    "admin:rep_page": (cb_admin_report_page, "d"),
+    "admin:triage_page": (cb_admin_triage, "d d?"),
+    "admin:triage_hide": (cb_admin_triage, "d d?"),
+    "admin:triage_unhide": (cb_admin_triage, "d d?"),
+    "admin:search": (cb_admin_search, "d"),
+    "admin:view": (cb_admin_search, "d"),
+    "admin:regions": (cb_admin_regions, ""),
+    "admin:region": (cb_admin_regions, "s"),
+}
+
+def parse_payload(spec: str, payload: Optional[str]) -> Optional[list]:
+    """Converts the part after the route key; None when it doesn't fit the spec."""
+    tokens = spec.split()
+    if tokens == ["s"]:
+        return [payload] if payload is not None else None
+    parts = payload.split(":") if payload is not None else []
+    required = sum(1 for t in tokens if not t.endswith("?"))
+    if not required <= len(parts) <= len(tokens):
+        return None
+    if not all(p.isdigit() for p in parts):
+        return None
+    return [int(p) for p in parts]
+
+def split_callback_data(data: str) -> Tuple[Optional[str], Optional[str]]:
+    """"head:action:payload" -> ("head:action", "payload"); payload is None when absent."""
+    head, sep, rest = data.partition(":")
+    action, sep2, payload = rest.partition(":")
+    return (f"{head}:{action}" if sep else None), (payload if sep2 else None)
+
+class RouteTable(BaseHandler):
+    def __init__(self, menu_routes: dict, callback_routes: dict):
+        super().__init__(self.dispatch)
+        self.menu_routes = dict(menu_routes)
+        self.callback_routes = dict(callback_routes)
+
+    def check_update(self, update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.callback_query is not None:
+            data = update.callback_query.data
+            if not data:
+                return None
+            key, payload = split_callback_data(data)
+            route = self.callback_routes.get(key)
+            if not route:
+                return None
+            args = parse_payload(route[1], payload)
+            return None if args is None else (route[0], args)
+        if update.message is not None and update.message.text:
+            callback = self.menu_routes.get(update.message.text)
+            return (callback, []) if callback else None
+        return None
+
+    def collect_additional_context(self, context, update, application, check_result):
+        context.args = check_result[1]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0](update, context)
+
+    async def dispatch(self, update, context):
+        pass  # never called; handle_update runs the matched route's callback
+
+    def instrument(self, wrap):
+        self.menu_routes = {k: wrap(cb) for k, cb in self.menu_routes.items()}
+        self.callback_routes = {k: (wrap(cb), spec) for k, (cb, spec) in self.callback_routes.items()}
+
+def build_route_table() -> RouteTable:
+    return RouteTable(MENU_ROUTES, CALLBACK_ROUTES)
+
+def with_payload_args(cb, spec: str):
+    """Gives a regex-registered route the same context.args the route table sets."""
+    async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        context.args = parse_payload(spec, split_callback_data(update.callback_query.data)[1])
+        return await cb(update, context)
+    return run
+
+def legacy_route_handlers() -> list:
+    """The same routes as one regex handler each, the way they used to be registered."""
+    handlers = [MessageHandler(filters.Regex(f"^{re.escape(text)}$"), cb) for text, cb in MENU_ROUTES.items()]
+    for key, (cb, spec) in CALLBACK_ROUTES.items():
+        tail = "".join(
+            {"d": r":\d+", "d?": r"(:\d+)?", "s": r":.*"}[t] for t in spec.split()
+        )
+        handlers.append(CallbackQueryHandler(with_payload_args(cb, spec), pattern=f"^{re.escape(key)}{tail}$"))
+    return handlers
+
+def bench_routing(rounds: int = 20000) -> List[Tuple[str, float, float]]:
+    """Per-update cost (µs) of finding the group-0 handler, regex chain vs route table."""
+    from telegram import CallbackQuery, Chat, Message as TgMessage, User as TgUser
+
+    tg_user = TgUser(id=1, first_name="bench", is_bot=False)
+    chat = Chat(id=1, type="private")
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def text_update(text):
+        return Update(0, message=TgMessage(1, now, chat, from_user=tg_user, text=text))
+
+    def callback_update(data):
+        msg = TgMessage(1, now, chat, from_user=tg_user, text="card")
+        return Update(0, callback_query=CallbackQuery("1", tg_user, "1", message=msg, data=data))
+
+    samples = [
+        ("menu: View Your Profile", text_update("View Your Profile")),
+        ("menu: Regions (admin)", text_update("Regions")),
+        ("cb: rq:accept", callback_update("rq:accept:12:3")),
+        ("cb: m:pay", callback_update("m:pay:7")),
+        ("cb: admin:view", callback_update("admin:view:99")),
+        ("cb: back:main", callback_update("back:main")),
+        ("unknown text", text_update("hello there")),
+    ]
+
+    def dispatch_cost(app, update) -> float:
+        handlers = app.handlers[0]
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for handler in handlers:
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    break
+        return (time.perf_counter() - started) / rounds * 1e6
+
+    apps = {}
+    for routed in (False, True):
+        app = Application.builder().token("0:bench").application_class(TrioApplication).build()
+        register_handlers(app, routed=routed)
+        apps[routed] = app
+    return [(name, dispatch_cost(apps[False], u), dispatch_cost(apps[True], u)) for name, u in samples]
+
+def register_handlers(app: Application, routed: bool = True):
+    # Activity tracking sees every update before any other handler, then dedup and throttle
+    app.add_handler(TypeHandler(Update, track_activity), group=-3)
+    app.add_handler(TypeHandler(Update, dedup_callback), group=-2)
+    app.add_handler(TypeHandler(Update, throttle_update), group=-1)
 
-    # Start menu callbacks
     app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CallbackQueryHandler(cb_start_menu, pattern=r"^start:(help|privacy|back)$"))
 
     # Create profile conversation
     create_conv = ConversationHandler(
@@ -1530,21 +4214,18 @@ def main():
     )
     app.add_handler(find_conv)
 
-    # Main menu buttons
-    app.add_handler(MessageHandler(filters.Regex(r"^View Your Profile$"), menu_view_profile))
-    app.add_handler(MessageHandler(filters.Regex(r"^Requests$"), menu_requests))
-    app.add_handler(MessageHandler(filters.Regex(r"^Refer 3 users to unlock 1 username$"), menu_referral))
-
-    # Request accept/reject callback
-    app.add_handler(CallbackQueryHandler(cb_request_action, pattern=r"^rq:(accept|reject):\d+$"))
-
-    # Unlock username callbacks
-    app.add_handler(CallbackQueryHandler(cb_match_unlock_free, pattern=r"^m:free:\d+$"))
-    app.add_handler(CallbackQueryHandler(cb_match_unlock_pay, pattern=r"^m:pay:\d+$"))
+    # Menu texts and stateless buttons (MENU_ROUTES/CALLBACK_ROUTES); placed where the first
+    # of them used to be registered so conversations keep precedence exactly as before
+    if routed:
+        app.add_handler(build_route_table())
+    else:
+        for handler in legacy_route_handlers():
+            app.add_handler(handler)
 
     # Payments handlers (Stars)
     app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
+    app.add_handler(CommandHandler("payments", cmd_payments))
 
     # /delete conversation
     delete_conv = ConversationHandler(
@@ -1556,14 +4237,10 @@ def main():
     )
     app.add_handler(delete_conv)
 
-    # Back to main
-    app.add_handler(CallbackQueryHandler(cb_back_main, pattern=r"^back:main$"))
-
     # Admin
     app.add_handler(CommandHandler("admin", cmd_admin))
-    app.add_handler(MessageHandler(filters.Regex(r"^Statics$"), admin_statics))
-    app.add_handler(MessageHandler(filters.Regex(r"^Reports$"), admin_reports))
-    app.add_handler(CallbackQueryHandler(cb_admin_report_review, pattern=r"^admin:rep_review:\d+$"))
+    app.add_handler(CommandHandler("export", cmd_export))
+    app.add_handler(CommandHandler("backup", cmd_backup))
 
     admin_bc_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex(r"^Broadcast$"), admin_broadcast_start)],
@@ -1595,8 +4272,42 @@ def main():
     # Unknown
     app.add_handler(MessageHandler(filters.ALL, unknown))
 
+def main():
+    app = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN)
+        .application_class(TrioApplication)
+        .rate_limiter(OUTBOUND_LIMITER)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    rebuild_report_stats()
+    load_hidden_users()
+    if CANDIDATE_INDEX is not None:
+        CANDIDATE_INDEX.load()
+
+    # Background jobs
+    app.job_queue.run_repeating(job_dispatch_outbox, interval=OUTBOX_INTERVAL, first=OUTBOX_INTERVAL)
+    app.job_queue.run_repeating(job_purge_outbox, interval=3600, first=600)
+    app.job_queue.run_repeating(job_report_digest, interval=REPORT_DIGEST_INTERVAL, first=REPORT_DIGEST_INTERVAL)
+    app.job_queue.run_repeating(job_flush_seen_filters, interval=SEEN_FLUSH_INTERVAL, first=SEEN_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(job_compact_requests, interval=COMPACTION_INTERVAL, first=300)
+    app.job_queue.run_repeating(job_flush_activity, interval=ACTIVITY_FLUSH_INTERVAL, first=ACTIVITY_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(job_archive_inactive_users, interval=ARCHIVE_INTERVAL, first=900)
+    app.job_queue.run_repeating(job_region_rollups, interval=ROLLUP_INTERVAL, first=120)
+    app.job_queue.run_repeating(job_backup, interval=BACKUP_INTERVAL, first=1800)
+    app.job_queue.run_repeating(job_write_events, interval=EVENT_FLUSH_INTERVAL, first=EVENT_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(job_prune_throttle, interval=600, first=600)
+    app.job_queue.run_repeating(
+        job_refresh_candidate_queues,
+        interval=CANDIDATE_QUEUE_REFRESH_SECONDS, first=CANDIDATE_QUEUE_REFRESH_SECONDS
+    )
+
+    register_handlers(app)
+
     logger.info("Bot started...")
     app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if not run_cli(sys.argv[1:]):
+        main()
\ No newline at end of file